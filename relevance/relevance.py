@@ -2,7 +2,11 @@ from __future__ import print_function, with_statement
 import pickle
 from os.path import join, dirname, abspath
 import numpy
-from sys import stdin, stdout
+import sys
+from sys import stdout
+
+sys.path.append(join(dirname(dirname(abspath(__file__))), "rnn"))
+from common import RequestQueue
 
 with open(join(dirname(abspath(__file__)), "dataset.pickle"), "rb") as f:
     words, _, embeddings = pickle.load(f)
@@ -27,9 +31,8 @@ def dist(w1, w2):
 
 
 def main():
-  while True:
+  for line in RequestQueue():
     try:
-      line = stdin.readline()
       if len(line.strip()) == 0:
         return
 
@@ -1,4 +1,10 @@
+from collections import deque
+import json
+import queue
 import re
+import sys
+import threading
+import time
 
 
 NAME_BREAKUP_RE = re.compile(r"[^a-zA-Z]+")
@@ -39,3 +45,236 @@ def extract_names(token):
         last = part[pos:]
         if last:
             yield from ret(last)
+
+
+class Request(object):
+    """
+    A single line of the line exchange protocol. The line may start with an
+    optional header "#<deadline>:<document id>\t", where the deadline is the
+    Unix time in seconds after which the reply is useless and the document id
+    identifies the editor buffer. Both parts can be empty.
+    """
+    __slots__ = ("payload", "doc", "deadline")
+
+    def __init__(self, line):
+        self.doc = self.deadline = None
+        if line.startswith("#") and "\t" in line:
+            header, line = line[1:].split("\t", 1)
+            deadline, _, doc = header.partition(":")
+            try:
+                self.deadline = float(deadline)
+            except ValueError:
+                pass
+            if doc:
+                self.doc = doc
+        self.payload = line
+
+
+class RequestQueue(object):
+    """
+    Reads the requests from the input stream in a background thread and yields
+    only those which are still worth answering. A request is dropped with an
+    immediate empty reply if it has expired or if a newer request for the same
+    document is already waiting. The replies keep the order of the requests.
+    """
+
+    def __init__(self, input=sys.stdin, output=sys.stdout):
+        self.output = output
+        self._incoming = queue.Queue()
+        self._pending = deque()
+        self._latest = {}
+        self._counter = 0
+        self.dropped = 0
+        reader = threading.Thread(target=self._read, args=(input,))
+        reader.daemon = True
+        reader.start()
+
+    def __len__(self):
+        return len(self._pending) + self._incoming.qsize()
+
+    def __iter__(self):
+        while True:
+            if not self._pending and not self._fetch(block=True):
+                return
+            self._fetch(block=False)
+            index, request = self._pending.popleft()
+            if request is None:
+                return
+            latest = self._latest.get(request.doc)
+            if latest == index:
+                # the last request of the document is answered
+                del self._latest[request.doc]
+            if (request.doc is not None and latest > index) or \
+                    (request.deadline is not None and
+                     request.deadline < time.time()):
+                self.dropped += 1
+                self.output.write("\n")
+                self.output.flush()
+                continue
+            yield request.payload
+
+    def _read(self, input):
+        for line in input:
+            self._incoming.put(Request(line))
+        self._incoming.put(None)
+
+    def _fetch(self, block):
+        fetched = False
+        while True:
+            try:
+                request = self._incoming.get(block=block)
+            except queue.Empty:
+                return fetched
+            self._counter += 1
+            if request is not None and request.doc is not None:
+                self._latest[request.doc] = self._counter
+            self._pending.append((self._counter, request))
+            if request is None:
+                return True
+            fetched = True
+            block = False
+
+
+STATS_REQUEST = "!stats"
+
+
+def add_stats_args(parser):
+    parser.add_argument("--stats", action="store_true",
+                        help="Collect the per-stage timings and the error "
+                             "counts. \"%s\" request replies with them."
+                             % STATS_REQUEST)
+    parser.add_argument("--stats-output",
+                        help="Periodically append the stats as JSON lines to "
+                             "this file.")
+    parser.add_argument("--stats-period", type=float, default=60,
+                        help="Seconds between the stats dumps.")
+
+
+class _NoopStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        return False
+
+
+_NOOP_STAGE = _NoopStage()
+
+
+class _Stage(object):
+    __slots__ = ("timing", "start")
+
+    def __init__(self, timing):
+        self.timing = timing
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        timing = self.timing
+        timing[0] += 1
+        timing[1] += elapsed
+        if elapsed > timing[2]:
+            timing[2] = elapsed
+        return False
+
+
+class Stats(object):
+    """
+    Latency and throughput counters of an inference process. When disabled,
+    stage() returns a shared no-op context manager and nothing is recorded.
+    With the output, a background thread appends them every period seconds,
+    also while no requests arrive.
+    """
+
+    def __init__(self, enabled=False, output=None, period=60):
+        self.enabled = enabled
+        self.output = output
+        self.period = period
+        self.start = self._last_dump = time.time()
+        self.requests = self._last_requests = 0
+        self.queue_depth = self.max_queue_depth = 0
+        self.dropped = 0
+        self.timings = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+        if self.enabled and self.output:
+            timer = threading.Thread(target=self._dump_periodically)
+            timer.daemon = True
+            timer.start()
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(enabled=args.stats or bool(args.stats_output),
+                   output=args.stats_output, period=args.stats_period)
+
+    def stage(self, name):
+        """
+        :param name: the name of the measured stage.
+        :return: the context manager which measures the time spent inside.
+        """
+        if not self.enabled:
+            return _NOOP_STAGE
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = [0, 0.0, 0.0]
+        return _Stage(timing)
+
+    def request(self, queue_depth=0, dropped=0):
+        """
+        Registers the next request.
+
+        :param queue_depth: the number of the requests waiting in the queue.
+        :param dropped: the total number of the stale requests dropped so far.
+        """
+        if not self.enabled:
+            return
+        self.requests += 1
+        self.dropped = dropped
+        self.queue_depth = queue_depth
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def error(self, e):
+        if not self.enabled:
+            return
+        name = type(e).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self):
+        now = time.time()
+        uptime = now - self.start
+        window = now - self._last_dump
+        return {
+            "time": now,
+            "enabled": self.enabled,
+            "uptime": uptime,
+            "requests": self.requests,
+            "rps": self.requests / uptime if uptime > 0 else 0,
+            "recent_rps": (self.requests - self._last_requests) / window
+            if window > 0 else 0,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "dropped": self.dropped,
+            "errors": dict(self.errors),
+            # copied at once, the timer thread reports while stages are added
+            "stages": {name: {"count": count, "total_ms": total * 1000,
+                              "mean_ms": total * 1000 / count if count else 0,
+                              "max_ms": peak * 1000}
+                       for name, (count, total, peak)
+                       in list(self.timings.items())},
+        }
+
+    def dump(self):
+        with self._lock:
+            report = self.report()
+            with open(self.output, "a") as fout:
+                fout.write(json.dumps(report) + "\n")
+            self._last_dump = report["time"]
+            self._last_requests = report["requests"]
+
+    def _dump_periodically(self):
+        while True:
+            time.sleep(max(0, self._last_dump + self.period - time.time()))
+            if time.time() - self._last_dump >= self.period:
+                self.dump()
@@ -0,0 +1,62 @@
+from keras import backend as K
+from keras.layers import Layer
+
+
+class PartsEmbedding(Layer):
+    """
+    Embeds each identifier as the sum of the embeddings of its stems. This is
+    the product of the multi-hot stem vector with the embedding matrix, but
+    the input holds only the stem indices instead of vocabulary sized vectors.
+
+    Input: (batch, steps, parts) stem indices plus one, 0 pads the missing
+    parts and words. Output: (batch, steps, output_dim).
+    """
+
+    def __init__(self, input_dim, output_dim, **kwargs):
+        """
+        :param input_dim: the vocabulary size, the padding index is extra.
+        :param output_dim: the embedding size.
+        """
+        self.input_dim = input_dim
+        self.output_dim = output_dim
+        super(PartsEmbedding, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        self.embeddings = self.add_weight(
+            name="embeddings", shape=(self.input_dim + 1, self.output_dim),
+            initializer="uniform")
+        super(PartsEmbedding, self).build(input_shape)
+
+    def call(self, inputs):
+        inputs = K.cast(inputs, "int32")
+        mask = K.cast(K.not_equal(inputs, 0), K.floatx())
+        return K.sum(K.gather(self.embeddings, inputs) * K.expand_dims(mask),
+                     axis=2)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0], input_shape[1], self.output_dim
+
+    def get_config(self):
+        config = {"input_dim": self.input_dim,
+                  "output_dim": self.output_dim}
+        config.update(super(PartsEmbedding, self).get_config())
+        return config
+
+
+custom_objects = {"PartsEmbedding": PartsEmbedding}
+
+
+def fill_parts(x, sample, words):
+    """
+    Writes the stem indices of the words to x[sample] aligned to the end, the
+    parts which do not fit are dropped.
+
+    :param x: int32 array of shape (samples, steps, parts).
+    :param words: list of tuples with the stem indices of each word.
+    """
+    steps, parts = x.shape[1:]
+    x[sample] = 0
+    for i, word in enumerate(words[-steps:]):
+        step = steps - min(len(words), steps) + i
+        for j, c in enumerate(word[:parts]):
+            x[sample, step, j] = c + 1
@@ -0,0 +1,162 @@
+import numpy
+from keras import backend as K
+from keras.layers import Layer
+import tensorflow as tf
+
+
+class HierarchicalSoftmax(Layer):
+    """
+    Two-level softmax over a frequency-sorted vocabulary. Words are split into
+    equally sized clusters of consecutive indices, so p(w) = p(c(w)) * p(w|c(w)).
+    During training only the clusters of the target words are evaluated, thus
+    the cost per sample is O(clusters + cluster_size) instead of O(vocabulary).
+
+    Inputs: [hidden (batch, dim), targets (batch, parts)], the targets are word
+    indices padded with -1. Output: the cross-entropy of each sample, averaged
+    over its target words.
+    """
+
+    def __init__(self, output_dim, cluster_size, **kwargs):
+        self.output_dim = output_dim
+        self.cluster_size = cluster_size
+        self.clusters = (output_dim + cluster_size - 1) // cluster_size
+        super(HierarchicalSoftmax, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        dim = input_shape[0][-1]
+        self.cluster_kernel = self.add_weight(
+            name="cluster_kernel", shape=(dim, self.clusters),
+            initializer="glorot_uniform")
+        self.cluster_bias = self.add_weight(
+            name="cluster_bias", shape=(self.clusters,), initializer="zeros")
+        self.word_kernel = self.add_weight(
+            name="word_kernel", shape=(self.clusters, dim, self.cluster_size),
+            initializer="glorot_uniform")
+        self.word_bias = self.add_weight(
+            name="word_bias", shape=(self.clusters, self.cluster_size),
+            initializer="zeros")
+        super(HierarchicalSoftmax, self).build(input_shape)
+
+    def call(self, inputs):
+        hidden, targets = inputs
+        targets = K.cast(targets, "int32")
+        mask = K.cast(K.greater_equal(targets, 0), K.floatx())
+        targets = K.maximum(targets, 0)
+        clusters = targets // self.cluster_size
+        offsets = targets % self.cluster_size
+
+        cluster_logp = tf.nn.log_softmax(
+            K.dot(hidden, self.cluster_kernel) + self.cluster_bias)
+        cluster_logp = K.sum(K.expand_dims(cluster_logp, 1) *
+                             K.one_hot(clusters, self.clusters), axis=-1)
+
+        kernel = K.gather(self.word_kernel, clusters)
+        bias = K.gather(self.word_bias, clusters)
+        logits = K.sum(K.expand_dims(K.expand_dims(hidden, 1), -1) * kernel,
+                       axis=2) + bias
+        # the tail of the last cluster does not correspond to any word
+        slots = K.expand_dims(clusters * self.cluster_size) + \
+            K.arange(0, self.cluster_size, dtype="int32")
+        logits -= 1e9 * K.cast(K.greater_equal(slots, self.output_dim),
+                               K.floatx())
+        word_logp = K.sum(tf.nn.log_softmax(logits) *
+                          K.one_hot(offsets, self.cluster_size), axis=-1)
+
+        loss = -K.sum(mask * (cluster_logp + word_logp), axis=-1)
+        return K.expand_dims(loss / K.maximum(K.sum(mask, axis=-1), 1))
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0][0], 1
+
+    def get_config(self):
+        config = {"output_dim": self.output_dim,
+                  "cluster_size": self.cluster_size}
+        config.update(super(HierarchicalSoftmax, self).get_config())
+        return config
+
+
+def hsoftmax_loss(y_true, y_pred):
+    return K.mean(y_pred, axis=-1)
+
+
+custom_objects = {"HierarchicalSoftmax": HierarchicalSoftmax,
+                  "hsoftmax_loss": hsoftmax_loss}
+
+
+def sort_by_frequency(vocabulary, freqs):
+    """
+    Reorders the vocabulary so that the indices go in the descending order of
+    the word frequencies. This way the frequent words share the first clusters.
+    """
+    order = sorted(vocabulary, key=lambda w: (-freqs[vocabulary[w]],
+                                              vocabulary[w]))
+    return {w: i for i, w in enumerate(order)}
+
+
+def _softmax(logits):
+    logits = logits - logits.max()
+    exps = numpy.exp(logits)
+    return exps / exps.sum()
+
+
+class HierarchicalPredictor(object):
+    """
+    Exact top-k inference over HierarchicalSoftmax. The clusters are visited in
+    the descending order of their probabilities and the search stops as soon as
+    the next cluster cannot contain a better word than the current k-th best.
+    """
+
+    def __init__(self, model, layer_name="hsoftmax"):
+        layer = model.get_layer(layer_name)
+        self.encoder = K.function([model.inputs[0], K.learning_phase()],
+                                  [layer.input[0]])
+        self.output_dim = layer.output_dim
+        self.cluster_size = layer.cluster_size
+        self.cluster_kernel, self.cluster_bias, self.word_kernel, \
+            self.word_bias = layer.get_weights()
+
+    def predict(self, x, number):
+        """
+        :param x: the input batch with a single sample.
+        :param number: the number of the best words to return.
+        :return: list of (word index, probability) in the descending order.
+        """
+        hidden = self.encoder([x, 0])[0][0]
+        cluster_probs = _softmax(hidden.dot(self.cluster_kernel) +
+                                 self.cluster_bias)
+        best = []
+        for cluster in numpy.argsort(cluster_probs)[::-1]:
+            if len(best) >= number and best[number - 1][1] >= \
+                    cluster_probs[cluster]:
+                break
+            start = cluster * self.cluster_size
+            size = min(self.cluster_size, self.output_dim - start)
+            logits = hidden.dot(self.word_kernel[cluster]) + \
+                self.word_bias[cluster]
+            probs = _softmax(logits[:size]) * cluster_probs[cluster]
+            best.extend((start + i, probs[i]) for i in range(size))
+            best.sort(key=lambda p: p[1], reverse=True)
+            del best[number:]
+        return best
+
+    def score(self, x, indices):
+        """
+        :param x: the input batch with a single sample.
+        :param indices: numpy array with the word indices to score.
+        :return: the probabilities of the specified words. Only the clusters \
+                 which contain them are evaluated.
+        """
+        hidden = self.encoder([x, 0])[0][0]
+        cluster_probs = _softmax(hidden.dot(self.cluster_kernel) +
+                                 self.cluster_bias)
+        probs = numpy.zeros(len(indices))
+        clusters = indices // self.cluster_size
+        for cluster in numpy.unique(clusters):
+            start = cluster * self.cluster_size
+            size = min(self.cluster_size, self.output_dim - start)
+            logits = hidden.dot(self.word_kernel[cluster]) + \
+                self.word_bias[cluster]
+            word_probs = _softmax(logits[:size]) * cluster_probs[cluster]
+            members = clusters == cluster
+            probs[members] = word_probs[indices[members] - start]
+        return probs
@@ -1,4 +1,5 @@
 import argparse
+import json
 import os
 import pickle
 import sys
@@ -12,6 +13,10 @@ with open("/dev/null", "w") as devnull:
     del stderr
 from nltk.stem.snowball import SnowballStemmer
 
+from common import RequestQueue, Stats, STATS_REQUEST, add_stats_args
+from embedding import PartsEmbedding, custom_objects as embedding_objects, \
+    fill_parts
+from hsoftmax import HierarchicalPredictor, custom_objects
 from tokens import *
 from train_ids import extract_names
 
@@ -21,12 +26,70 @@ def parse_args():
     parser.add_argument("--model", required=True)
     parser.add_argument("--number", type=int, default=5)
     parser.add_argument("--only-public", action="store_true")
+    add_stats_args(parser)
     return parser.parse_args()
 
 
+class DenseScorer(object):
+    """
+    Computes the probabilities of the requested words under the output softmax
+    layer without running the whole model.
+    """
+
+    def __init__(self, model):
+        layer = model.layers[-1]
+        self.encoder = backend.function(
+            [model.inputs[0], backend.learning_phase()], [layer.input])
+        self.kernel, self.bias = layer.get_weights()
+
+    def score(self, x, indices):
+        hidden = self.encoder([x, 0])[0][0]
+        logits = hidden.dot(self.kernel) + self.bias
+        # the log-softmax normalizer is taken over the whole vocabulary
+        top = logits.max()
+        norm = top + numpy.log(numpy.exp(logits - top).sum())
+        return numpy.exp(logits[indices] - norm)
+
+
+def score_candidates(scorer, x, candidates, vocabulary, stemmer):
+    """
+    Ranks the given identifiers by the model instead of the whole vocabulary.
+
+    :param scorer: DenseScorer or HierarchicalPredictor.
+    :param x: the input batch with a single sample.
+    :param candidates: list of identifiers, e.g. the ones suggested by gocode.
+    :param vocabulary: stem -> index mapping.
+    :param stemmer: the stemmer which was used to build the vocabulary.
+    :return: list of (candidate, score) in the descending order of the score. \
+             The score is the mean model probability of the candidate's \
+             stems, the stems missing from the vocabulary have 0, so the \
+             candidates without known stems score exactly 0.
+    """
+    parts = []
+    for c in candidates:
+        parts.append([vocabulary.get(s) for s in (stemmer.stem(p)
+                                                  for p in extract_names(c))])
+    indices = sorted({i for p in parts for i in p if i is not None})
+    scores = numpy.zeros(len(candidates))
+    if indices:
+        probs = dict(zip(indices, scorer.score(x, numpy.array(indices))))
+        for i, p in enumerate(parts):
+            if p:
+                # each of the stems is trained to receive 1/len(p) of the mass
+                scores[i] = sum(probs.get(j, 0) for j in p) / len(p)
+    order = numpy.argsort(-scores, kind="mergesort")
+    return [(candidates[i], scores[i]) for i in order]
+
+
 def main():
     args = parse_args()
-    model = models.load_model(args.model)
+    model = models.load_model(args.model, custom_objects=dict(
+        custom_objects, **embedding_objects))
+    if "hsoftmax" in (layer.name for layer in model.layers):
+        predictor = HierarchicalPredictor(model)
+    else:
+        predictor = None
+    scorer = predictor or DenseScorer(model)
     with open(args.model + ".voc", "rb") as fin:
         vocabulary = pickle.load(fin)
     ivoc = [None] * len(vocabulary)
@@ -34,35 +97,83 @@ def main():
         ivoc[val] = key
     maxlen = model.inputs[0].shape[1].value
     stemmer = SnowballStemmer("english")
-    x = numpy.zeros((1, maxlen, len(vocabulary)))
-    for line in sys.stdin:
+    # the older models take the one-hot stems instead of the indices
+    indexed = any(isinstance(layer, PartsEmbedding) for layer in model.layers)
+    if indexed:
+        x = numpy.zeros((1, maxlen, model.inputs[0].shape[2].value),
+                        dtype=numpy.int32)
+    else:
+        x = numpy.zeros((1, maxlen, len(vocabulary)))
+    stats = Stats.from_args(args)
+    requests = RequestQueue()
+    for line in requests:
+        if line.strip() == STATS_REQUEST:
+            print(json.dumps(stats.report()))
+            sys.stdout.flush()
+            continue
+        # the stats polls are not counted as requests
+        stats.request(len(requests), requests.dropped)
         try:
-          ctx = eval(line)
-          x[:] = 0
-          word = False
-          words = []
-          for c in ctx:
-              if c == ID_S:
-                  word = True
-              elif word:
-                  word = False
-                  if args.only_public and c[0].islower() and c not in BUILTINS:
-                      continue
-                  wadd = tuple(vocabulary[stemmer.stem(p)]
-                               for p in extract_names(c))
-                  if wadd:
-                      words.append(wadd)
-          for i, w in enumerate(words):
-              for c in w:
-                  x[0, maxlen - len(words) + i, c] = 1
-          preds = model.predict(x, verbose=0)[0]
-          best = numpy.argsort(preds)[::-1][:args.number]
-          preds /= preds[best[0]]
-          print(" ".join("%s@%.3f" % (ivoc[i], preds[i]) for i in best))
-          sys.stdout.flush()
+          with stats.stage("parse"):
+              # "<context>\t<candidate>,<candidate>,..." ranks only the candidates
+              candidates = None
+              if "\t" in line:
+                  line, candidates = line.split("\t", 1)
+                  candidates = [c for c in candidates.strip().split(",") if c]
+              ctx = eval(line)
+          with stats.stage("stem"):
+              word = False
+              words = []
+              for c in ctx:
+                  if c == ID_S:
+                      word = True
+                  elif word:
+                      word = False
+                      if args.only_public and c[0].islower() and c not in BUILTINS:
+                          continue
+                      wadd = tuple(vocabulary[stemmer.stem(p)]
+                                   for p in extract_names(c))
+                      if wadd:
+                          words.append(wadd)
+          with stats.stage("tensor"):
+              if indexed:
+                  fill_parts(x, 0, words)
+              else:
+                  x[:] = 0
+                  for i, w in enumerate(words):
+                      for c in w:
+                          x[0, maxlen - len(words) + i, c] = 1
+          if candidates is not None:
+              with stats.stage("score"):
+                  scores = score_candidates(
+                      scorer, x, candidates, vocabulary, stemmer)
+              with stats.stage("write"):
+                  # the probabilities are small, %.3f rounds most to 0
+                  print(" ".join("%s@%.3g" % p for p in scores))
+                  sys.stdout.flush()
+              continue
+          if predictor is not None:
+              with stats.stage("predict"):
+                  best = predictor.predict(x, args.number)
+              with stats.stage("write"):
+                  print(" ".join("%s@%.3f" % (ivoc[i], p / best[0][1])
+                                 for i, p in best))
+                  sys.stdout.flush()
+              continue
+          with stats.stage("predict"):
+              preds = model.predict(x, verbose=0)[0]
+          with stats.stage("sort"):
+              best = numpy.argsort(preds)[::-1][:args.number]
+              preds /= preds[best[0]]
+          with stats.stage("write"):
+              print(" ".join("%s@%.3f" % (ivoc[i], preds[i]) for i in best))
+              sys.stdout.flush()
         except Exception as e:
+          stats.error(e)
           print('')
           sys.stdout.flush()
+    if stats.output:
+        stats.dump()
     backend.clear_session()
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import argparse
+import json
 import os
 import sys
 
@@ -10,6 +11,7 @@ with open("/dev/null", "w") as devnull:
     sys.stderr = stderr
     del stderr
 
+from common import RequestQueue, Stats, STATS_REQUEST, add_stats_args
 from tokens import *
 
 
@@ -21,6 +23,7 @@ def parse_args():
                         help="The input format is the same as in train_ids.py")
     parser.add_argument("--word2vec", help="Use word2vec embeddings from the "
                                            "specified pickle file.")
+    add_stats_args(parser)
     return parser.parse_args()
 
 
@@ -29,23 +32,40 @@ def main():
     model = models.load_model(args.model)
     maxlen = model.inputs[0].shape[1].value
     x = numpy.zeros((1, maxlen, len(token_map)))
-    for line in sys.stdin:
-        try:
-            ctx = eval(line)
-            x[:] = 0
-            if args.unified:
-                ctx = [ctx[i] for i in range(len(ctx))
-                       if i == 0 or ctx[i - 1] != ID_S]
-            for i in range(maxlen):
-                k = len(ctx) - maxlen + i
-                if k >= 0:
-                    x[0, i] = token_map[ctx[k]]
-            preds = prediction2token(model.predict(x, verbose=0)[0], args.number)
-            sys.stdout.write("%s\n" % " ".join("%r@%.3f" % p for p in preds))
+    stats = Stats.from_args(args)
+    requests = RequestQueue()
+    for line in requests:
+        if line.strip() == STATS_REQUEST:
+            sys.stdout.write(json.dumps(stats.report()) + "\n")
             sys.stdout.flush()
-        except:
+            continue
+        # the stats polls are not counted as requests
+        stats.request(len(requests), requests.dropped)
+        try:
+            with stats.stage("parse"):
+                ctx = eval(line)
+            with stats.stage("tensor"):
+                x[:] = 0
+                if args.unified:
+                    ctx = [ctx[i] for i in range(len(ctx))
+                           if i == 0 or ctx[i - 1] != ID_S]
+                for i in range(maxlen):
+                    k = len(ctx) - maxlen + i
+                    if k >= 0:
+                        x[0, i] = token_map[ctx[k]]
+            with stats.stage("predict"):
+                preds = model.predict(x, verbose=0)[0]
+            with stats.stage("sort"):
+                preds = prediction2token(preds, args.number)
+            with stats.stage("write"):
+                sys.stdout.write("%s\n" % " ".join("%r@%.3f" % p for p in preds))
+                sys.stdout.flush()
+        except Exception as e:
+            stats.error(e)
             sys.stdout.write("\n")
             sys.stdout.flush()
+    if stats.output:
+        stats.dump()
     backend.clear_session()
 
 if __name__ == "__main__":
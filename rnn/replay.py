@@ -0,0 +1,328 @@
+"""
+Replays the editor typing sessions against the inference processes through the
+same line protocol the extension uses and reports the latency percentiles, the
+throughput, the resident memory and the CPU usage of each process.
+
+Every context from the input files is turned into a session which sends its
+growing prefixes, one per keystroke.
+"""
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+from tokens import *
+
+RNN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--toks-model", help="Drive infer_toks.py with this model.")
+    parser.add_argument("--ids-model", help="Drive infer_ids.py with this model.")
+    parser.add_argument("--relevance", action="store_true",
+                        help="Drive relevance/relevance.py.")
+    parser.add_argument("--toks-input", default=os.path.join(RNN_DIR, "test_toks.tsv"))
+    parser.add_argument("--ids-input", default=os.path.join(RNN_DIR, "test_ids.tsv"))
+    parser.add_argument("--sessions", type=int, default=1,
+                        help="The number of the concurrent typing sessions.")
+    parser.add_argument("--rate", type=float, default=5,
+                        help="Keystrokes per second in each session.")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Replay the input contexts this many times.")
+    parser.add_argument("--min-prefix", type=int, default=1)
+    parser.add_argument("--doc-ids", action="store_true",
+                        help="Send the session as the document id so that "
+                             "stale requests are coalesced.")
+    parser.add_argument("--deadline", type=float, default=0,
+                        help="Request deadline in milliseconds, 0 disables.")
+    parser.add_argument("--ids-candidates", action="store_true",
+                        help="Send the identifiers from the context as the "
+                             "candidates to infer_ids.py.")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="Seconds to wait for the pending replies.")
+    parser.add_argument("--output", help="Write the JSON report to this file.")
+    parser.add_argument("--baseline", help="Compare with this JSON report.")
+    return parser.parse_args()
+
+
+def read_contexts(path):
+    with open(path, errors="ignore") as fin:
+        return [eval(line) for line in fin if line.strip()]
+
+
+def format_context(ctx):
+    return "[%s]" % ", ".join(repr(c) for c in ctx)
+
+
+def identifiers(ctx):
+    return [c for p, c in zip(ctx, ctx[1:]) if p == ID_S]
+
+
+def relevance_request(ctx):
+    idents = identifiers(ctx)
+    if len(idents) < 2:
+        return None
+    words = sorted(set(idents[:-1]))
+    return ",".join([idents[-1]] + words)
+
+
+def ids_request(ctx, candidates):
+    line = format_context(ctx)
+    if candidates:
+        names = sorted(set(identifiers(ctx)))
+        if names:
+            line += "\t" + ",".join(names)
+    return line
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def latency_report(latencies):
+    lat = [l * 1000 for l in latencies]
+    return {
+        "mean": sum(lat) / len(lat) if lat else 0,
+        "p50": percentile(lat, 50),
+        "p95": percentile(lat, 95),
+        "p99": percentile(lat, 99),
+        "max": max(lat) if lat else 0,
+    }
+
+
+class ProcessClient(object):
+    """
+    Talks to a single line exchange process. The replies come in the order of
+    the requests, so the latency is measured against the FIFO of send times.
+    The empty replies to the dropped requests are immediate and are timed
+    apart from the answered ones.
+    """
+
+    def __init__(self, name, argv):
+        self.name = name
+        self.proc = subprocess.Popen(
+            argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True, bufsize=1)
+        self.lock = threading.Lock()
+        self.sent = deque()
+        self.latencies = []
+        self.empty_latencies = []
+        self.requests = 0
+        self.done = threading.Condition()
+        self.rss_peak = 0
+        self.cpu_start = self.cpu_end = 0
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def send(self, line, doc=None, deadline=0):
+        if doc is not None or deadline:
+            line = "#%s:%s\t%s" % (
+                "%.3f" % (time.time() + deadline / 1000) if deadline else "",
+                doc or "", line)
+        with self.lock:
+            self.sent.append(time.perf_counter())
+            self.requests += 1
+            self.proc.stdin.write(line + "\n")
+            self.proc.stdin.flush()
+
+    def wait(self, timeout):
+        end = time.time() + timeout
+        with self.done:
+            while self.sent and time.time() < end:
+                self.done.wait(max(0, end - time.time()))
+        return not self.sent
+
+    def reset(self):
+        self.latencies = []
+        self.empty_latencies = []
+        self.requests = 0
+
+    def close(self):
+        self.proc.stdin.close()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+    def _read(self):
+        for line in self.proc.stdout:
+            now = time.perf_counter()
+            with self.done:
+                if not self.sent:
+                    continue
+                latency = now - self.sent.popleft()
+                if line.strip():
+                    self.latencies.append(latency)
+                else:
+                    self.empty_latencies.append(latency)
+                self.done.notify_all()
+
+    def sample(self):
+        """
+        Updates the resource usage from /proc, Linux only.
+        """
+        pid = self.proc.pid
+        try:
+            with open("/proc/%d/status" % pid) as fin:
+                for line in fin:
+                    if line.startswith("VmRSS:"):
+                        self.rss_peak = max(self.rss_peak, int(line.split()[1]) * 1024)
+            with open("/proc/%d/stat" % pid) as fin:
+                fields = fin.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (IOError, OSError, IndexError, ValueError):
+            return None
+
+    def report(self, elapsed):
+        replies = len(self.latencies) + len(self.empty_latencies)
+        cpu = self.cpu_end - self.cpu_start
+        return {
+            "requests": self.requests,
+            "replies": replies,
+            "empty": len(self.empty_latencies),
+            "throughput": replies / elapsed if elapsed > 0 else 0,
+            # the answered requests only, the empty replies skew them low
+            "latency_ms": latency_report(self.latencies),
+            "empty_latency_ms": latency_report(self.empty_latencies),
+            "rss_peak_mb": self.rss_peak / (1 << 20),
+            "cpu_seconds": cpu,
+            "cpu_percent": 100 * cpu / elapsed if elapsed > 0 else 0,
+        }
+
+
+def start_clients(args):
+    """
+    :return: list of (client, function which converts the context to a request \
+             line or None, the contexts).
+    """
+    python = sys.executable
+    targets = []
+    if args.toks_model:
+        targets.append((ProcessClient("toks", [
+            python, os.path.join(RNN_DIR, "infer_toks.py"), "--model", args.toks_model]),
+            format_context, read_contexts(args.toks_input)))
+    if args.ids_model or args.relevance:
+        ids_contexts = read_contexts(args.ids_input)
+    if args.ids_model:
+        targets.append((ProcessClient("ids", [
+            python, os.path.join(RNN_DIR, "infer_ids.py"), "--model", args.ids_model]),
+            lambda ctx: ids_request(ctx, args.ids_candidates), ids_contexts))
+    if args.relevance:
+        targets.append((ProcessClient("relevance", [
+            python, os.path.join(os.path.dirname(RNN_DIR), "relevance", "relevance.py")]),
+            relevance_request, ids_contexts))
+    return targets
+
+
+def warm_up(targets, timeout):
+    for client, convert, contexts in targets:
+        for ctx in contexts:
+            line = convert(ctx)
+            if line:
+                client.send(line)
+                break
+    for client, _, _ in targets:
+        if not client.wait(timeout):
+            raise TimeoutError("%s did not reply during the warm up" % client.name)
+        client.reset()
+
+
+def run_session(session, client, convert, contexts, args):
+    interval = 1 / args.rate if args.rate > 0 else 0
+    doc = "session-%d-%s" % (session, client.name) if args.doc_ids else None
+    for ctx in contexts:
+        for k in range(args.min_prefix, len(ctx) + 1):
+            start = time.perf_counter()
+            line = convert(ctx[:k])
+            if line:
+                client.send(line, doc, args.deadline)
+            delay = interval - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+
+def replay(args):
+    targets = start_clients(args)
+    if not targets:
+        raise ValueError("Nothing to drive: specify --toks-model, --ids-model "
+                         "or --relevance")
+    try:
+        warm_up(targets, args.timeout)
+        threads = []
+        for client, convert, contexts in targets:
+            contexts = contexts * args.repeat
+            client.cpu_start = client.sample() or 0
+            for session in range(args.sessions):
+                thread = threading.Thread(target=run_session, args=(
+                    session, client, convert,
+                    contexts[session::args.sessions], args))
+                thread.daemon = True
+                threads.append(thread)
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            for client, _, _ in targets:
+                client.sample()
+            time.sleep(0.2)
+        for client, _, _ in targets:
+            client.wait(args.timeout)
+        elapsed = time.perf_counter() - start
+        for client, _, _ in targets:
+            client.cpu_end = client.sample() or client.cpu_start
+    finally:
+        for client, _, _ in targets:
+            client.close()
+    return {
+        "config": {k: v for k, v in vars(args).items()
+                   if k not in ("output", "baseline")},
+        "elapsed": elapsed,
+        "processes": {client.name: client.report(elapsed)
+                      for client, _, _ in targets},
+    }
+
+
+def compare(report, baseline):
+    for name, stats in sorted(report["processes"].items()):
+        base = baseline["processes"].get(name)
+        if base is None:
+            continue
+        print(name)
+        for key, value, base_value in itertools.chain(
+                (("latency p%s" % q, stats["latency_ms"]["p%s" % q],
+                  base["latency_ms"]["p%s" % q]) for q in (50, 95, 99)),
+                (("empty", stats["empty"], base["empty"]),
+                 ("throughput", stats["throughput"], base["throughput"]),
+                 ("rss_peak_mb", stats["rss_peak_mb"], base["rss_peak_mb"]),
+                 ("cpu_percent", stats["cpu_percent"], base["cpu_percent"]))):
+            ratio = value / base_value if base_value else float("nan")
+            print("  %-12s %10.2f  baseline %10.2f  x%.2f" % (key, value, base_value, ratio))
+
+
+def main():
+    args = parse_args()
+    report = replay(args)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(report, fout, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fin:
+            compare(report, json.load(fin))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
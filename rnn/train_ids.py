@@ -7,6 +7,8 @@ from keras import models, layers, regularizers, optimizers
 from nltk.stem.snowball import SnowballStemmer
 
 from common import extract_names
+from embedding import PartsEmbedding, fill_parts
+from hsoftmax import HierarchicalSoftmax, hsoftmax_loss, sort_by_frequency
 from tokens import *
 
 
@@ -19,6 +21,8 @@ def parse_args():
     parser.add_argument("--start-offset", type=int, default=1)
     parser.add_argument("--validation", type=float, default=0)
     parser.add_argument("--neurons", type=int, default=128)
+    parser.add_argument("--embedding", type=int, default=128,
+                        help="The size of the stem embeddings.")
     parser.add_argument("--dense-neurons", type=int, default=0)
     parser.add_argument("--learning-rate", type=float, default=0.001)
     parser.add_argument("--type", default="LSTM")
@@ -32,6 +36,13 @@ def parse_args():
     parser.add_argument("--cache", action="store_true")
     parser.add_argument("--shuffle", action="store_true")
     parser.add_argument("--only-public", action="store_true")
+    parser.add_argument("--softmax", choices=("full", "hierarchical"),
+                        default="full",
+                        help="The hierarchical softmax scales with the square "
+                             "root of the vocabulary size.")
+    parser.add_argument("--cluster-size", type=int, default=0,
+                        help="The number of words in each hierarchical softmax "
+                             "cluster. Defaults to sqrt(vocabulary size).")
     return parser.parse_args()
 
 
@@ -51,14 +62,18 @@ def main():
     maxlines = args.maxlines
     public = args.only_public
     start_offset = args.start_offset
+    hierarchical = args.softmax == "hierarchical"
     stemmer = SnowballStemmer("english")
+    cache = args.input + (".idx.hsm.pickle" if hierarchical else ".idx.pickle")
 
-    if os.path.exists(args.input + ".pickle"):
+    if os.path.exists(cache):
         print("loading the cached dataset...")
-        with open(args.input + ".pickle", "rb") as fin:
-            x, y = pickle.load(fin)
+        with open(cache, "rb") as fin:
+            x, y, vocabulary_size = pickle.load(fin)
     else:
         vocabulary = {}
+        freqs = []
+        max_parts = 0
         samples_num = 0
         with open(args.input, errors="ignore") as fin:
             for lineno, line in enumerate(fin):
@@ -77,17 +92,30 @@ def main():
                         if public and c[0].islower() and c not in BUILTINS:
                             continue
                         word_num += 1
+                        parts = 0
                         for part in extract_names(c):
                             part = stemmer.stem(part)
-                            vocabulary.setdefault(part, len(vocabulary))
+                            index = vocabulary.setdefault(part, len(vocabulary))
+                            if index == len(freqs):
+                                freqs.append(0)
+                            freqs[index] += 1
+                            parts += 1
+                        max_parts = max(max_parts, parts)
                 samples_num += max(0, word_num - start_offset)
         print("vocabulary:", len(vocabulary), "samples:", samples_num)
+        if hierarchical:
+            vocabulary = sort_by_frequency(vocabulary, freqs)
         with open(args.output + ".voc", "wb") as fout:
             pickle.dump(vocabulary, fout, protocol=-1)
-        x = numpy.zeros((samples_num, maxlen, len(vocabulary)),
-                        dtype=numpy.float32)
-        y = numpy.zeros((samples_num, len(vocabulary)),
-                        dtype=numpy.float32)
+        vocabulary_size = len(vocabulary)
+        # the stem indices of the words instead of vocabulary sized vectors
+        x = numpy.zeros((samples_num, maxlen, max(max_parts, 1)),
+                        dtype=numpy.int32)
+        if hierarchical:
+            y = numpy.full((samples_num, max_parts), -1, dtype=numpy.int32)
+        else:
+            y = numpy.zeros((samples_num, len(vocabulary)),
+                            dtype=numpy.float32)
         print("the worst is behind - we allocated %s bytes" %
               commaed_int(x.nbytes + y.nbytes))
         samples_num = 0
@@ -112,20 +140,19 @@ def main():
                         if wadd:
                             words.append(wadd)
                 for i in range(start_offset, len(words)):
-                    for j in range(maxlen):
-                        k = i - maxlen + j
-                        if k >= 0:
-                            for c in words[k]:
-                                x[samples_num, j, c] = 1
-                    for c in words[i]:
-                        y[samples_num, c] = 1
-                    y[samples_num] /= len(words[i])
+                    fill_parts(x, samples_num, words[max(0, i - maxlen):i])
+                    if hierarchical:
+                        y[samples_num, :len(words[i])] = words[i]
+                    else:
+                        for c in words[i]:
+                            y[samples_num, c] = 1
+                        y[samples_num] /= len(words[i])
                     samples_num += 1
         if args.cache:
             print("saving the cache...")
             try:
-                with open(args.input + ".pickle", "wb") as fout:
-                    pickle.dump((x, y), fout, protocol=-1)
+                with open(cache, "wb") as fout:
+                    pickle.dump((x, y, vocabulary_size), fout, protocol=-1)
             except Exception as e:
                 print(type(e), e)
     print("x:", x.shape)
@@ -137,12 +164,13 @@ def main():
         numpy.random.shuffle(x)
         numpy.random.set_state(rng_state)
         numpy.random.shuffle(y)
-    model = train(x, y, **args.__dict__)
+    model = train(x, y, vocabulary_size=vocabulary_size, **args.__dict__)
     model.save(args.output, overwrite=True)
 
 
-def train(x, y, **kwargs):
+def train(x, y, vocabulary_size, **kwargs):
     neurons = kwargs.get("neurons", 128)
+    embedding = kwargs.get("embedding", 128)
     dense_neurons = kwargs.get("dense_neurons", 0)
     learning_rate = kwargs.get("learning_rate", 0.001)
     dropout = kwargs.get("dropout", 0)
@@ -154,16 +182,32 @@ def train(x, y, **kwargs):
     epochs = kwargs.get("epochs", 50)
     layer_type = kwargs.get("type", "LSTM")
     validation = kwargs.get("validation", 0)
+    softmax = kwargs.get("softmax", "full")
+    cluster_size = kwargs.get("cluster_size", 0)
     model = models.Sequential()
+    model.add(PartsEmbedding(vocabulary_size, embedding,
+                             input_shape=x[0].shape, dtype="int32"))
     model.add(getattr(layers, layer_type)(
         neurons, dropout=dropout, recurrent_dropout=recurrent_dropout,
         kernel_regularizer=regularizers.l2(regularization),
-        input_shape=x[0].shape, activation=activation))
+        activation=activation))
     if dense_neurons > 0:
         model.add(layers.Dense(dense_neurons, activation="prelu"))
         model.add(layers.normalization.BatchNormalization())
-    model.add(layers.Dense(x[0].shape[-1], activation="softmax"))
     optimizer = getattr(optimizers, optimizer)(lr=learning_rate, clipnorm=1.)
+    if softmax == "hierarchical":
+        if cluster_size <= 0:
+            cluster_size = int(numpy.ceil(numpy.sqrt(vocabulary_size)))
+        targets = layers.Input(shape=y[0].shape, dtype="int32")
+        loss = HierarchicalSoftmax(vocabulary_size, cluster_size,
+                                   name="hsoftmax")([model.output, targets])
+        model = models.Model(inputs=[model.input, targets], outputs=loss)
+        model.compile(loss=hsoftmax_loss, optimizer=optimizer)
+        model.fit([x, y], numpy.zeros((len(x), 1), dtype=numpy.float32),
+                  batch_size=batch_size, epochs=epochs,
+                  validation_split=validation)
+        return model
+    model.add(layers.Dense(vocabulary_size, activation="softmax"))
     model.compile(loss="categorical_crossentropy", optimizer=optimizer,
                   metrics=["accuracy", "top_k_categorical_accuracy"])
     model.fit(x, y, batch_size=batch_size, epochs=epochs,
@@ -11,6 +11,8 @@ import * as path from 'path';
 const mainPkgRegex = /package main/g;
 const funcRegex = /^func *$/;
 const mainFuncRegex = /func main()/g;
+// milliseconds after which the model replies are no longer useful
+const MODEL_TIMEOUT = 1500;
 
 export default class GoCompletionProvider implements CompletionItemProvider {
 	private extPath: string;
@@ -63,6 +65,7 @@ export default class GoCompletionProvider implements CompletionItemProvider {
 			}]);
 		}
 
+		const doc = document.uri.toString();
 		const lastFuncIdx = text.substring(0, pos).lastIndexOf('\nfunc');
 		const lastFunc = text.substring(
 			text.indexOf(' ', lastFuncIdx), 
@@ -77,10 +80,10 @@ export default class GoCompletionProvider implements CompletionItemProvider {
 						.then(items => items.filter(c => c.label !== 'main' && c.label !== lastFunc)),
 					this.tokenize(pos, text, true),
 				]).then(([idents, items, tokens]) => this.getCompletions(
-					idents, items, tokens, line, position,
+					idents, items, tokens, line, position, doc,
 				)),
 				this.tokenize(pos, text)
-					.then(tokens => this.suggestNextTokens(tokens, line)),
+					.then(tokens => this.suggestNextTokens(tokens, line, doc)),
 			]).then(([completions, suggestions]) => this.processSuggestions(
 				document,
 				position,
@@ -97,6 +100,7 @@ export default class GoCompletionProvider implements CompletionItemProvider {
 	 * @param tokens tokens of the code
 	 * @param line current line content
 	 * @param position current position
+	 * @param doc optional id of the document
 	 */
 	getCompletions(
 		idents: string,
@@ -104,8 +108,9 @@ export default class GoCompletionProvider implements CompletionItemProvider {
 		tokens: string,
 		line: string,
 		position: Position,
+		doc?: string,
 	): Thenable<CompletionItem[]> {
-		return this.guessIdentifiers(tokens, items)
+		return this.guessIdentifiers(tokens, items, doc)
 			.then(suggestedItems => {
 				if (!suggestedItems || suggestedItems.length === 0) {
 					return this.sortedCompletions(
@@ -203,19 +208,24 @@ export default class GoCompletionProvider implements CompletionItemProvider {
 	/**
 	 * Runs the token model and returns the list of possible next tokens.
 	 * @param tokens list of tokens in a format used by the token model
+	 * @param line current line content
+	 * @param doc optional id of the document, newer requests for the same
+	 * document make the older ones obsolete
 	 */
-	suggestNextTokens(tokens: string, line: string): Thenable<string[]> {
+	suggestNextTokens(tokens: string, line: string, doc?: string): Thenable<string[]> {
 		tokens = tokens.trim();
 		if (!line.trim()) {
 			tokens = tokens.substring(0, tokens.length - 1) + ', ";"]';
 		}
 
-		return this.suggester.write(tokens.trim())
+		return this.suggester.write(tokens.trim(), doc, MODEL_TIMEOUT)
 			.then(line => {
+				if (!line || !line.trim()) return [];
+
 				const suggestions = line.trim().split(' ');
 				if (suggestions[0].startsWith("';'")) {
 					const nextTokens = tokens.substring(0, tokens.length - 1) + ', ";"]';
-					return this.suggestNextTokens(nextTokens, line);
+					return this.suggestNextTokens(nextTokens, line, doc);
 				}
 
 				return suggestions;
@@ -223,30 +233,40 @@ export default class GoCompletionProvider implements CompletionItemProvider {
 	}
 
 	/**
-	 * Runs the identifier model to infer identifiers based on the tokens.
-	 * After that, the result is filtered and ranked.
+	 * Runs the identifier model to rank the identifiers suggested by gocode
+	 * based on the tokens. Only the given candidates are scored by the model.
 	 * @param tokens list of tokens in a format required by the model
 	 * @param items autocompletion items suggested by gocode
+	 * @param doc optional id of the document
 	 */
-	guessIdentifiers(tokens: string, items: CompletionItem[]): Thenable<CompletionItem[] | undefined> {
-		return this.idGuesser.write(tokens)
+	guessIdentifiers(
+		tokens: string,
+		items: CompletionItem[],
+		doc?: string,
+	): Thenable<CompletionItem[] | undefined> {
+		if (items.length === 0) return Promise.resolve(items);
+
+		return this.idGuesser.write(
+			`${tokens.trim()}\t${items.map(it => it.label).join(',')}`, doc, MODEL_TIMEOUT,
+		)
 			.then(line => {
-				if (!line.trim()) return items;
+				if (!line || !line.trim()) return items;
 
 				const confidences = {};
 				line.trim()
 					.split(' ')
 					.forEach(p => {
 						const [ident, confidence] = p.split('@');
-						items.filter(it => it.label.toLowerCase().indexOf(ident) >= 0)
-							.forEach(m => {
-								confidences[m.label] = Number(confidence) + (confidences[m.label] || 0);
-							});
+						confidences[ident] = Number(confidence);
 					});
 
+				// nothing was scored, getCompletions falls back to sortedCompletions
+				if (!items.some(it => (confidences[it.label] || 0) > 0)) return [];
+
+				// the candidates the model cannot score keep the gocode order at the end
 				return items
-					.filter(it => (confidences[it.label] || 0) > 0)
-					.sort((a, b) => confidences[a.label] - confidences[b.label]);
+					.slice()
+					.sort((a, b) => (confidences[b.label] || 0) - (confidences[a.label] || 0));
 			});
 	}
 
@@ -110,7 +110,8 @@ export class LineExchangeProcess {
                 console.log(`process ${this.name} received line:`, line);
             }
 
-            let res = this.resolvers.pop();
+            // the process replies in the order of the requests
+            let res = this.resolvers.shift();
             if (res) {
                 res(line);
             } else {
@@ -133,8 +134,16 @@ export class LineExchangeProcess {
      * Writes a line to the process and returns a promise that will be
      * resolved with the line the process outputs to stdout.
      * @param line line to write
+     * @param doc optional id of the document the request belongs to, the
+     * process drops the older pending requests of the same document
+     * @param timeout optional number of milliseconds after which the process
+     * replies with an empty line instead of computing the answer
      */
-    write(line: string): Thenable<string | undefined> {
+    write(line: string, doc?: string, timeout?: number): Thenable<string | undefined> {
+        if (doc !== undefined || timeout !== undefined) {
+            const deadline = timeout !== undefined ? (Date.now() + timeout) / 1000 : '';
+            line = `#${deadline}:${doc || ''}\t${line.trim()}`;
+        }
         if (this.debug) {
             console.log(`process ${this.name} wrote line:`, line);
         }
@@ -160,6 +169,6 @@ export class LineExchangeProcess {
             return Promise.resolve(undefined);
         }
 
-        return this.promises.pop();
+        return this.promises.shift();
     }
 }
\ No newline at end of file
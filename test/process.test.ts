@@ -0,0 +1,25 @@
+import * as assert from 'assert';
+import { spawn } from 'child_process';
+
+import { LineExchangeProcess } from '../src/process';
+
+// replies to every request with its payload after a delay, so the requests queue up
+const ECHO = `
+const rl = require('readline').createInterface({ input: process.stdin });
+rl.on('line', line => setTimeout(() => console.log(line.split('\\t').pop()), 20));
+`;
+
+suite("Process Tests", () => {
+    test('replies are matched to the requests in order', () => {
+        const proc = spawn(process.execPath, ['-e', ECHO]);
+        const exchange = new LineExchangeProcess('echo', proc, false);
+        return Promise.all([
+            exchange.write('first', 'doc.go'),
+            exchange.write('second', 'doc.go'),
+        ]).then(([first, second]) => {
+            proc.kill();
+            assert.equal(first, 'first');
+            assert.equal(second, 'second');
+        });
+    });
+});
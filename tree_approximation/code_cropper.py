@@ -4,7 +4,12 @@ select snippet from code and prepare X & y:
 X - code without snippet
 y - snippet, position in initial code, UAST of this snippet
 """
-from random import randint
+from collections import OrderedDict
+from collections.abc import Sequence
+import json
+import logging
+import os
+import shutil
 from typing import Union
 
 import ast2vec
@@ -12,16 +17,242 @@ from ast2vec.bblfsh_roles import _get_role_id as get_role_id
 from ast2vec.repo2.base import Repo2Base, RepoTransformer
 from modelforge import generate_meta
 from modelforge.model import Model, split_strings, write_model, merge_strings
+import numpy
 
 FOR_EACH = get_role_id("FOR_EACH")
 FUNCTION_DECLARATION = get_role_id("FUNCTION_DECLARATION")
 SIMPLE_IDENTIFIER = get_role_id("SIMPLE_IDENTIFIER")
 
+_log = logging.getLogger("CodeCropper")
+
+
+def role_mask(roles):
+    """
+    Bitmask of roles: bit number role_id is set for each role
+    :param roles: iterable of role ids
+    :return: int
+    """
+    mask = 0
+    for role in roles:
+        mask |= 1 << role
+    return mask
+
+
+def iter_nodes(root):
+    """
+    Iterative pre-order traversal of UAST - deep trees do not hit the recursion limit
+    :param root: UAST node
+    :return: generator of nodes in the same order as the recursive traversal
+    """
+    yield root
+    # stack of (children, index of the next child to visit)
+    stack = [(root.children, 0)]
+    while stack:
+        children, i = stack[-1]
+        if i == len(children):
+            stack.pop()
+            continue
+        stack[-1] = (children, i + 1)
+        node = children[i]
+        yield node
+        if len(node.children):
+            stack.append((node.children, 0))
+
+
+def node_position(node, log=None):
+    """
+    :param node: UAST node
+    :param log: logger of the skipped nodes, None means the module logger
+    :return: (start_line, start_col, end_line, end_col) or None if position is unknown
+    """
+    if (node.start_position.line != 0) and (node.start_position.col != 0) and \
+            (node.end_position.line != 0) and (node.end_position.col != 0):
+        return (node.start_position.line, node.start_position.col,
+                node.end_position.line, node.end_position.col)
+    (log or _log).debug("Skipped node without position: roles %s, %d:%d - %d:%d",
+                        list(node.roles), node.start_position.line, node.start_position.col,
+                        node.end_position.line, node.end_position.col)
+    return None
+
+
+def match_roles(uast, mask, log=None):
+    """
+    Walk UAST once and select nodes with any of the roles
+    :param uast: UAST
+    :param mask: role_mask() of the roles
+    :param log: logger of the skipped nodes, None means the module logger
+    :return: generator of (mask of matched roles, zero-based position, node)
+    """
+    for node in iter_nodes(uast):
+        matched = role_mask(node.roles) & mask
+        if not matched:
+            continue
+        pos = node_position(node, log)
+        if pos is not None:
+            yield matched, [p - 1 for p in pos], node
+
+
+class SourceFile:
+    """
+    File contents decoded once with the offsets of the line starts. Snippets are cut by
+    character offsets from the shared text instead of splitting it into lines; the columns
+    are counted in characters as in the decoded lines of the original code.
+    """
+    def __init__(self, text: str):
+        self.text = text
+        self.line_starts = [0]
+        start = text.find("\n")
+        while start >= 0:
+            self.line_starts.append(start + 1)
+            start = text.find("\n", start + 1)
+
+    @classmethod
+    def read(cls, path):
+        with open(path, "rb") as f:
+            # an undecodable byte becomes one character instead of failing the repository
+            return cls(f.read().decode("utf-8", "replace"))
+
+    def offset(self, line, col):
+        """
+        :param line: zero-based line
+        :param col: zero-based column in characters
+        :return: character offset in the text
+        """
+        if line >= len(self.line_starts):
+            return len(self.text)
+        return min(self.line_starts[line] + col, len(self.text))
+
+    def span(self, pos):
+        """
+        :param pos: (start_line, start_col, end_line, end_col) (zero-based index, inclusive end)
+        :return: (start, end) character offsets of the snippet, end is exclusive
+        """
+        st_l, st_c, en_l, en_c = pos
+        return self.offset(st_l, st_c), self.offset(en_l, en_c + 1)
+
+    def snippet(self, start, end):
+        """
+        :return: y_text - the code between the offsets
+        """
+        return self.text[start:end]
+
+    def crop(self, start, end):
+        """
+        :return: X - the code without the snippet between the offsets
+        """
+        return self.text[:start] + self.text[end:]
+
+
+class CroppedTexts(Sequence):
+    """
+    X or y_text reconstructed on access from (file id, start, end) spans. The files must stay
+    readable at their paths; consecutive samples of the same file share one read.
+    """
+    def __init__(self, files, spans, snippets, root=None):
+        """
+        Initialization
+        :param files: list of file paths, relative to root if it is set
+        :param spans: array of (file id, start, end) - see SourceFile.span
+        :param snippets: True for y_text, False for X
+        :param root: the repository directory
+        """
+        self._files = files
+        self._spans = spans
+        self._snippets = snippets
+        self._root = root
+        self._file_id = None
+        self._source = None
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        file_id, start, end = (int(v) for v in self._spans[index])
+        if file_id != self._file_id:
+            path = self._files[file_id]
+            if self._root is not None:
+                path = os.path.join(self._root, path)
+            self._source = SourceFile.read(path)
+            self._file_id = file_id
+        if self._snippets:
+            return self._source.snippet(start, end)
+        return self._source.crop(start, end)
+
+
+class LazyUASTs(Sequence):
+    """
+    Read-only sequence of UASTs which are deserialized on access. The serialized UASTs stay
+    concatenated in one bytes blob as merge_strings() wrote them. Up to cache_size decoded
+    nodes are kept in LRU order, 0 disables the cache.
+    """
+    def __init__(self, strings, lengths, parse, cache_size=0):
+        """
+        Initialization
+        :param strings: bytes - the concatenated serialized UASTs
+        :param lengths: array with the length of each serialized UAST
+        :param parse: function which deserializes one UAST
+        :param cache_size: maximum number of decoded UASTs to keep
+        """
+        self._strings = strings
+        self._offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=self._offsets[1:])
+        self._parse = parse
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _index(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("UAST index out of range")
+        return index
+
+    def serialized(self, index):
+        """
+        :param index: sample index
+        :return: bytes of the serialized UAST without deserializing it
+        """
+        index = self._index(index)
+        return self._strings[int(self._offsets[index]):int(self._offsets[index + 1])]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = self._index(index)
+        node = self._cache.get(index)
+        if node is not None:
+            self._cache.move_to_end(index)
+            return node
+        node = self._parse(self.serialized(index))
+        if self.cache_size > 0:
+            self._cache[index] = node
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return node
+
 
 class CodeCropperBaseModel(Model):
     NAME = "CodeCropperBaseModel"
+    # number of deserialized UASTs cached by y_uast of a loaded model, 0 disables the cache
+    UAST_CACHE_SIZE = 0
 
-    def construct(self, X=None, y_text=None, y_pos=None, y_uast=None):
+    def construct(self, X=None, y_text=None, y_pos=None, y_uast=None, files=None, spans=None,
+                  root=None):
+        """
+        Either X & y_text or files & spans should be passed - in the latter case X & y_text
+        are reconstructed on access from the files under the root directory, see CroppedTexts.
+        """
+        self._files = files
+        self._spans = spans
+        self._root = root
+        if spans is not None and X is None:
+            X = CroppedTexts(files, spans, snippets=False, root=root)
+            y_text = CroppedTexts(files, spans, snippets=True, root=root)
         self._X = X
         self._y_text = y_text
         self._y_pos = y_pos
@@ -48,6 +279,18 @@ class CodeCropperBaseModel(Model):
     def y_uast(self):
         return self._y_uast
 
+    @property
+    def files(self):
+        return self._files
+
+    @property
+    def spans(self):
+        return self._spans
+
+    @property
+    def root(self):
+        return self._root
+
     def dump(self) -> str:
         """
         Returns the string with the brief information about the model.
@@ -60,9 +303,19 @@ Number of samples: {}""" % (len(self.X))
         return desc
 
     def _to_dict(self):
-        return {"X": merge_strings(self.X), "y_text": merge_strings(self.y_text),
-                "y_pos": self.y_pos, "y_uast": merge_strings([uast.SerializeToString()
-                                                              for uast in self.y_uast])}
+        if isinstance(self.y_uast, LazyUASTs):
+            # a loaded model is saved without deserializing its UASTs
+            y_uast = [self.y_uast.serialized(i) for i in range(len(self.y_uast))]
+        else:
+            y_uast = [uast.SerializeToString() for uast in self.y_uast]
+        if self.spans is not None:
+            tree = {"files": merge_strings(self.files), "spans": self.spans}
+            if self.root is not None:
+                tree["root"] = self.root
+        else:
+            tree = {"X": merge_strings(self.X), "y_text": merge_strings(self.y_text)}
+        tree.update({"y_pos": self.y_pos, "y_uast": merge_strings(y_uast)})
+        return tree
 
     def save(self, output, deps: Union[None, list]=None) -> None:
         """
@@ -86,15 +339,133 @@ Number of samples: {}""" % (len(self.X))
 
     def _load_tree(self, tree: dict) -> None:
         """
-        Attaches the needed data from the tree.
+        Attaches the needed data from the tree. UASTs are deserialized on access - see LazyUASTs.
 
         :param tree: asdf file tree.
         :return: None
         """
 
-        self.construct(X=split_strings(tree["X"]), y_text=split_strings(tree["y_text"]),
-                       y_pos=tree["y_pos"], y_uast=[self.parse_bblfsh_response(response)
-                                                    for response in split_strings(tree["y_uast"])])
+        # the arrays of the tree are read lazily and Model.load() closes the file right after
+        # this call, so the blob is copied here and only the deserialization is deferred
+        y_uast = LazyUASTs(bytes(tree["y_uast"]["strings"][0]),
+                           numpy.array(tree["y_uast"]["lengths"]),
+                           self.parse_bblfsh_response, self.UAST_CACHE_SIZE)
+        if "spans" in tree:
+            self.construct(files=split_strings(tree["files"]), spans=numpy.array(tree["spans"]),
+                           y_pos=tree["y_pos"], y_uast=y_uast, root=tree.get("root"))
+        else:
+            self.construct(X=split_strings(tree["X"]), y_text=split_strings(tree["y_text"]),
+                           y_pos=tree["y_pos"], y_uast=y_uast)
+
+
+class CodeCropperShardWriter:
+    """
+    Writes samples to a directory of fixed-size CodeCropperBaseModel shards as they are
+    produced, so memory stays bounded by shard_size. The manifest lists the shards and is
+    rewritten after each of them - an interrupted run leaves a readable prefix.
+    """
+    MANIFEST = "manifest.json"
+
+    def __init__(self, output, shard_size=10000, deps: Union[None, list]=None):
+        """
+        Initialization
+        :param output: directory for the shards and the manifest
+        :param shard_size: number of samples per shard
+        :param deps: the list of dependencies of each shard model
+        """
+        if shard_size < 1:
+            raise ValueError("shard_size must be positive, got %s" % shard_size)
+        os.makedirs(output, exist_ok=True)
+        self.output = output
+        self.shard_size = shard_size
+        self.deps = deps
+        self.shards = []
+        self._clear()
+
+    def _clear(self):
+        self._X, self._y_text, self._y_pos, self._y_uast = [], [], [], []
+
+    def __len__(self):
+        return sum(shard["samples"] for shard in self.shards) + len(self._X)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def add(self, X, y_text, y_pos, y_uast):
+        self._X.append(X)
+        self._y_text.append(y_text)
+        self._y_pos.append(y_pos)
+        self._y_uast.append(y_uast)
+        if len(self._X) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered samples as a new shard
+        :return: None
+        """
+        if not self._X:
+            return
+        name = "%05d.asdf" % len(self.shards)
+        CodeCropperBaseModel().construct(
+            X=self._X, y_text=self._y_text, y_pos=self._y_pos, y_uast=self._y_uast,
+        ).save(os.path.join(self.output, name), self.deps)
+        self.shards.append({"file": name, "samples": len(self._X)})
+        self._clear()
+        self._write_manifest()
+
+    def _write_manifest(self):
+        path = os.path.join(self.output, self.MANIFEST)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"shard_size": self.shard_size, "samples": len(self),
+                       "shards": self.shards}, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+        """
+        Writes the last incomplete shard and the manifest
+        :return: path to the manifest
+        """
+        self.flush()
+        self._write_manifest()
+        return os.path.join(self.output, self.MANIFEST)
+
+
+class CodeCropperShardReader:
+    """
+    Iterates over the samples written by CodeCropperShardWriter, one shard in memory at a time
+    """
+    def __init__(self, path):
+        """
+        Initialization
+        :param path: shards directory or path to its manifest
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, CodeCropperShardWriter.MANIFEST)
+        with open(path) as f:
+            self.manifest = json.load(f)
+        self.directory = os.path.dirname(path)
+
+    def __len__(self):
+        return self.manifest["samples"]
+
+    def shards(self):
+        """
+        :return: generator of CodeCropperBaseModel-s, loaded on demand
+        """
+        for shard in self.manifest["shards"]:
+            yield CodeCropperBaseModel().load(source=os.path.join(self.directory, shard["file"]))
+
+    def __iter__(self):
+        """
+        :return: generator of (X, y_text, y_pos, y_uast)
+        """
+        for model in self.shards():
+            yield from zip(model.X, model.y_text, model.y_pos, model.y_uast)
 
 
 class CodeCropperBase(Repo2Base):
@@ -108,13 +479,23 @@ class CodeCropperBase(Repo2Base):
     """
     MODEL_CLASS = CodeCropperBaseModel
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, shard_size=0, store_spans=False, **kwargs):
         """
         Initialization
         :param args: some arguments to pass to super
+        :param shard_size: number of samples per shard, see Repo2CropTransformer
+        :param store_spans: produce (file id, start, end) spans instead of X & y_text - \
+                            the files must stay on disk, Repo2CropTransformer accepts only \
+                            local repositories
         :param kwargs: some arguments to pass to super
         """
+        if shard_size and store_spans:
+            raise ValueError("store_spans cannot be written in shards")
         super(CodeCropperBase, self).__init__(*args, **kwargs)
+        self.shard_size = shard_size
+        self.store_spans = store_spans
+        # CodeCropperShardWriter which receives the samples instead of convert_uasts result
+        self.shard_writer = None
 
     def _pos_extractor(self, node):
         """
@@ -125,9 +506,8 @@ class CodeCropperBase(Repo2Base):
         raise NotImplementedError
 
     def _find_positions(self, root):
-        yield from self._pos_extractor(root)
-        for ch in root.children:
-            yield from self._find_positions(ch)
+        for node in iter_nodes(root):
+            yield from self._pos_extractor(node)
 
     @staticmethod
     def _one2zero_based_index(pos):
@@ -144,107 +524,189 @@ class CodeCropperBase(Repo2Base):
         return positions
 
     @staticmethod
-    def _prepare_xy(text, positions):
+    def _prepare_xy(source, positions):
         """
-        Prepare X, y from 1 file
+        Prepare X, y from 1 file - a sample for every position
 
-        :param text: list of strings - code itself
+        :param source: SourceFile - code itself
         :param positions: list of (pos, node)
-        :return: list of (X, y)
+        :return: generator of (X, y_text, y_pos, y_uast)
         """
-        if len(positions) == 0:
-            return []
+        for pos, uast in positions:
+            start, end = source.span(pos)
+            yield source.crop(start, end), source.snippet(start, end), pos, uast
 
-        # randomly select 1 position - can be modified in future
-        pos = positions[randint(0, len(positions) - 1)]
-
-        st_l, st_c, en_l, en_c = pos[0]
+    def iter_samples(self, file_uast_generator):
+        """
+        Crop files one by one
+        :param file_uast_generator: generator of files with their UASTs
+        :return: generator of (X, y_text, y_pos, y_uast)
+        """
+        for file_uast in file_uast_generator:
+            source = SourceFile.read(file_uast.filepath)
+            positions = self.find_positions(file_uast.response.uast)
+            yield from self._prepare_xy(source, positions)
 
-        # select code before snippet
-        if st_c > 0:
-            new_text = text[:st_l + 1]
-            new_text[-1] = new_text[-1][:st_c]
-        else:
-            new_text = text[:st_l + 1]
+    def convert_spans(self, file_uast_generator):
+        """
+        Locate the samples without copying any text
+        :param file_uast_generator: generator of files with their UASTs
+        :return: files, array of (file id, start, end), y_pos, y_uast
+        """
+        files, spans, y_pos, y_uast = [], [], [], []
+        for file_uast in file_uast_generator:
+            positions = self.find_positions(file_uast.response.uast)
+            if not positions:
+                continue
+            source = SourceFile.read(file_uast.filepath)
+            for pos, uast in positions:
+                spans.append((len(files),) + source.span(pos))
+                y_pos.append(pos)
+                y_uast.append(uast)
+            files.append(file_uast.filepath)
+        return files, numpy.array(spans, dtype=numpy.int64).reshape(-1, 3), y_pos, y_uast
 
-        # select code after snippet
-        if en_c < len(text[en_l]) - 1:
-            new_text.append(text[en_l][en_c:])
-        else:
-            new_text.append("\n")
-        new_text.extend(text[en_l + 1:])
+    def convert_uasts(self, file_uast_generator):
+        if self.store_spans:
+            return self.convert_spans(file_uast_generator)
+        if self.shard_writer is not None:
+            # samples go to disk as they are produced, nothing is accumulated
+            for xy in self.iter_samples(file_uast_generator):
+                self.shard_writer.add(*xy)
+            return [], [], [], []
+        X, y_text, y_pos, y_uast = [], [], [], []
+        for xy in self.iter_samples(file_uast_generator):
+            X.append(xy[0])
+            y_text.append(xy[1])
+            y_pos.append(xy[2])
+            y_uast.append(xy[3])
+        return X, y_text, y_pos, y_uast
 
-        # select snippet
-        snippet = text[st_l:en_l + 1]
-        snippet[0] = snippet[0][st_c:]
-        snippet[-1] = snippet[-1][:en_c + 1]
 
-        uast = pos[1]
-        pos = pos[1]
-        return [("\n".join(new_text), "\n".join(snippet), pos, uast)]
+class CodeCropperRoles(CodeCropperBase):
+    """
+    Select nodes with any of several roles in one traversal. The samples are not labeled with
+    the matched role - it is among the roles of their y_uast, find_positions_by_role() groups
+    the positions for the callers which need them apart
+    """
+    def __init__(self, *args, roles=(FUNCTION_DECLARATION,), **kwargs):
+        """
+        Initialization
+        :param args: some arguments to pass to super
+        :param roles: iterable of role ids to select
+        :param kwargs: some arguments to pass to super
+        """
+        super(CodeCropperRoles, self).__init__(*args, **kwargs)
+        self.roles = tuple(roles)
+        self.mask = role_mask(self.roles)
 
-    def convert_uasts(self, file_uast_generator):
-        X, y_text, y_pos, y_uast = [], [], [], []
-        for file_uast in file_uast_generator:
-            text = []
-            with open(file_uast.filepath) as f:
-                for line in f.readlines():
-                    text.append(line.rstrip())
+    def _match(self, uast):
+        return match_roles(uast, self.mask, self._log)
 
-            positions = self.find_positions(file_uast.response.uast)
+    def find_positions(self, uast):
+        """
+        Find positions of nodes with any of the roles
+        :param uast: UAST
+        :return: list of (start_line, start_col, end_line, end_col) (zero-based index) & node
+        """
+        return [(pos, node) for _, pos, node in self._match(uast)]
 
-            for xy in self._prepare_xy(text, positions):
-                X.append(xy[0])
-                y_text.append(xy[1])
-                y_pos.append(xy[2])
-                y_uast.append(xy[3])
-        return X, y_text, y_pos, y_uast
+    def find_positions_by_role(self, uast):
+        """
+        Find positions of nodes grouped by role - a node with several of the roles is listed
+        under each of them
+        :param uast: UAST
+        :return: dict role -> list of (pos, node) in the order of pre-order traversal
+        """
+        positions = {role: [] for role in self.roles}
+        for mask, pos, node in self._match(uast):
+            for role in self.roles:
+                if mask >> role & 1:
+                    positions[role].append((pos, node))
+        return positions
 
 
-class CodeCropperRole(CodeCropperBase):
+class CodeCropperRole(CodeCropperRoles):
     """
-    Select specific roles
+    Select specific role
     """
     def __init__(self, *args, role=FUNCTION_DECLARATION, **kwargs):
         """
         Initialization
         :param args: some arguments to pass to super
+        :param role: role id to select
         :param kwargs: some arguments to pass to super
         """
-        super(CodeCropperBase, self).__init__(*args, **kwargs)
+        super(CodeCropperRole, self).__init__(*args, roles=(role,), **kwargs)
         self.role = role
 
-    def _pos_extractor(self, node):
-        """
-        Extract position of nodes with specific role
-        :param node: UAST node
-        :return: return ((start_line, start_col, end_line, end_col), node) or None
-        """
-        if self.role in node.roles:
-            if (node.start_position.line != 0) and (node.start_position.col != 0) and \
-                    (node.end_position.line != 0) and (node.end_position.col != 0):
-                yield ((node.start_position.line, node.start_position.col,
-                       node.end_position.line, node.end_position.col), node)
-            else:
-                print(node.roles, node.start_position.line, node.start_position.col,
-                      node.end_position.line, node.end_position.col)
-
 
 class Repo2CropTransformer(RepoTransformer):
+    """
+    Pass shard_size=N to write each repository as a directory of shards with N samples
+    instead of a single model.
+    """
     WORKER_CLASS = CodeCropperRole
 
     def dependencies(self):
         return []
 
+    def process_repo(self, url_or_path, output):
+        shard_size = self._args.get("shard_size", 0)
+        if not shard_size:
+            return super(Repo2CropTransformer, self).process_repo(url_or_path, output)
+        output = os.path.splitext(output)[0]
+        if os.path.exists(output):
+            overwrite_existing = self._args.get("overwrite_existing",
+                                                self.WORKER_CLASS.DEFAULT_OVERWRITE_EXISTING)
+            if not overwrite_existing:
+                self._log.warning("Shards %s already exist, skipping.", output)
+                return True
+            # stale shards of the previous run would stay next to the new manifest
+            self._log.warning("Shards %s already exist, but will be overwritten.", output)
+            shutil.rmtree(output)
+        try:
+            repo2 = self.WORKER_CLASS(**self._args)
+            with CodeCropperShardWriter(output, shard_size, self.dependencies()) as writer:
+                repo2.shard_writer = writer
+                result = repo2.convert_repository(url_or_path)
+            if result is None:
+                # convert_repository() has logged the bblfsh errors
+                shutil.rmtree(output, ignore_errors=True)
+                return False
+            if not len(writer):
+                # an empty directory would be skipped as done by the next run
+                shutil.rmtree(output, ignore_errors=True)
+                raise ValueError("Empty result")
+            return True
+        except ValueError as e:
+            self._log.warning("Failed to construct model for %s: %s", url_or_path, e)
+            return False
+        except:
+            self._log.exception("Unhandled error in %s.process_repo() at %s." % (
+                type(self).__name__, url_or_path))
+            shutil.rmtree(output, ignore_errors=True)
+            return False
+
     def result_to_model_kwargs(self, result, url_or_path):
+        if self._args.get("store_spans", False):
+            # a cloned repository is removed right after convert_uasts()
+            if not os.path.isdir(url_or_path):
+                raise ValueError("store_spans requires a local repository, got %s" % url_or_path)
+            files, spans, y_pos, y_uast = result
+            if not len(spans):
+                raise ValueError("Empty result")
+            root = os.path.abspath(url_or_path)
+            return {"files": [os.path.relpath(path, root) for path in files], "spans": spans,
+                    "y_pos": y_pos, "y_uast": y_uast, "root": root}
         X, y_text, y_pos, y_uast = result
         if not X:
             raise ValueError("Empty result")
-        if len(X) != len(y_text) != len(y_pos) != len(y_uast):
+        if not len(X) == len(y_text) == len(y_pos) == len(y_uast):
             err_msg = "Different lengths: len(X) = {}, len(y_text) = {}, len(y_pos) = {}, "
             err_msg += "len(y_uast) = {}"
-            raise ValueError(err_msg % (len(X), len(y_text), len(y_pos), len(y_uast)))
-        return {"X": X, "y_text": y_text, "y_text": y_text, "y_uast": y_uast}
+            raise ValueError(err_msg.format(len(X), len(y_text), len(y_pos), len(y_uast)))
+        return {"X": X, "y_text": y_text, "y_pos": y_pos, "y_uast": y_uast}
 
 if __name__ == "__main__":
     FOR = 79
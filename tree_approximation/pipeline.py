@@ -0,0 +1,333 @@
+"""
+Parallel code cropping of local repositories:
+parse - a bounded pool of in-flight parse requests, each slot keeps its own parser connection
+crop - UAST traversal and snippet extraction for batches of files in a process pool
+Bounded queues between the stages make the faster stage wait for the slower one, so memory
+stays bounded. LocalParser stands in for the bblfsh server to benchmark the pipeline offline:
+
+    python pipeline.py --parser local --processes 8 --in-flight 16 path/to/repo
+    python pipeline.py --parser bblfsh --bblfsh 0.0.0.0:9432 --output shards/ path/to/repo
+"""
+import argparse
+import ast
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from code_cropper import CodeCropperBase, CodeCropperBaseModel, CodeCropperShardWriter, \
+    FUNCTION_DECLARATION, SourceFile, get_role_id, match_roles, role_mask
+
+LANGUAGES = {".py": "Python", ".java": "Java"}
+
+LocalParseResponse = namedtuple("LocalParseResponse", ["uast", "errors"])
+
+
+class LocalParser:
+    """
+    Stand-in for the bblfsh client: parses Python files in process with the ast module and
+    converts the tree to the bblfsh UAST protobuf with a few roles, enough for the cropper.
+    latency emulates the round trip to the server.
+    """
+    ROLES = {
+        "FunctionDef": ("FUNCTION_DECLARATION",),
+        "AsyncFunctionDef": ("FUNCTION_DECLARATION",),
+        "For": ("FOR_EACH",),
+        "AsyncFor": ("FOR_EACH",),
+        "Name": ("SIMPLE_IDENTIFIER",),
+        "arg": ("SIMPLE_IDENTIFIER",),
+    }
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.roles = {name: [get_role_id(role) for role in roles]
+                      for name, roles in self.ROLES.items()}
+
+    def parse(self, filename, language=None, timeout=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if language not in (None, "Python"):
+            return LocalParseResponse(None, ["unsupported language %s" % language])
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+            tree = ast.parse(data, filename)
+        except (SyntaxError, ValueError) as e:
+            return LocalParseResponse(None, [str(e)])
+        return LocalParseResponse(self._to_uast(tree, data.split(b"\n")), [])
+
+    @staticmethod
+    def _col(lines, line, offset):
+        """
+        :return: the column in characters - ast counts the column offsets in UTF-8 bytes
+        """
+        return len(lines[line - 1][:offset].decode("utf-8", "replace"))
+
+    def _to_uast(self, tree, lines):
+        # see CodeCropperBaseModel.parse_bblfsh_response about the import
+        from bblfsh.github.com.bblfsh.sdk.uast.generated_pb2 import Node
+        root = Node()
+        stack = [(tree, root)]
+        while stack:
+            pynode, node = stack.pop()
+            node.internal_type = type(pynode).__name__
+            node.roles.extend(self.roles.get(node.internal_type, ()))
+            token = getattr(pynode, "id", None) or getattr(pynode, "arg", None) or \
+                getattr(pynode, "name", None)
+            if isinstance(token, str):
+                node.token = token
+            if getattr(pynode, "end_lineno", None) is not None:
+                # 1-based columns, the end is inclusive
+                node.start_position.line = pynode.lineno
+                node.start_position.col = self._col(lines, pynode.lineno, pynode.col_offset) + 1
+                node.end_position.line = pynode.end_lineno
+                node.end_position.col = self._col(lines, pynode.end_lineno,
+                                                  pynode.end_col_offset)
+            for child in ast.iter_child_nodes(pynode):
+                stack.append((child, node.children.add()))
+        return root
+
+
+def make_parser_factory(name, endpoint=None, latency=0):
+    """
+    :param name: "local" or "bblfsh"
+    :return: function which creates a parser - called once per in-flight slot
+    """
+    if name == "local":
+        return lambda: LocalParser(latency)
+    if name == "bblfsh":
+        def factory():
+            from bblfsh import BblfshClient
+            return BblfshClient(endpoint)
+        return factory
+    raise ValueError("Unknown parser: %s" % name)
+
+
+def find_files(paths, languages=tuple(LANGUAGES.values())):
+    """
+    :param paths: files and directories to walk
+    :return: generator of (filepath, language)
+    """
+    for path in paths:
+        if os.path.isfile(path):
+            walk = [(os.path.dirname(path), [], [os.path.basename(path)])]
+        else:
+            walk = os.walk(path)
+        for dirname, _, filenames in walk:
+            for filename in sorted(filenames):
+                language = LANGUAGES.get(os.path.splitext(filename)[1])
+                if language in languages:
+                    yield os.path.join(dirname, filename), language
+
+
+def crop_batch(batch, mask):
+    """
+    Runs in the worker processes. The files which fail are logged and skipped.
+    :param batch: list of (filepath, serialized UAST)
+    :param mask: role_mask() of the roles to crop
+    :return: list of (X, y_text, y_pos, y_uast), number of the skipped files
+    """
+    samples = []
+    failed = 0
+    for filepath, uast in batch:
+        try:
+            uast = CodeCropperBaseModel.parse_bblfsh_response(uast)
+            positions = [(pos, node) for _, pos, node in match_roles(uast, mask)]
+            if positions:
+                samples.extend(list(CodeCropperBase._prepare_xy(SourceFile.read(filepath),
+                                                                positions)))
+        except Exception:
+            logging.getLogger("ParallelCropper").exception("While cropping %s", filepath)
+            failed += 1
+    return samples, failed
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
+
+
+class ParallelCropper:
+    """
+    Crops files with the parse requests and the traversal running concurrently. The parsed
+    UASTs are passed to the processes serialized, in batches of batch_size files; at most
+    max_batches batches are pending and at most in_flight files are being parsed.
+    """
+    def __init__(self, parser_factory, roles=(FUNCTION_DECLARATION,), in_flight=8,
+                 processes=None, batch_size=16, max_batches=None, timeout=None):
+        """
+        Initialization
+        :param parser_factory: function which creates a parser with parse(filepath, \
+                               language=, timeout=) -> response with uast and errors
+        :param roles: iterable of role ids to crop
+        :param in_flight: number of concurrent parse requests
+        :param processes: number of cropping processes, None means the number of CPUs
+        :param batch_size: number of files per cropping task
+        :param max_batches: number of pending cropping tasks, None means twice processes
+        :param timeout: timeout of a parse request
+        """
+        self.parser_factory = parser_factory
+        self.mask = role_mask(roles)
+        self.in_flight = in_flight
+        self.processes = processes or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.max_batches = max_batches or 2 * self.processes
+        self.timeout = timeout
+        self.parsed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._log = logging.getLogger(type(self).__name__)
+
+    def _parse_loop(self, tasks, parsed, stop, errors):
+        try:
+            # the parser and its connection are reused for all the files of this slot
+            parser = self.parser_factory()
+            while True:
+                task = _get(tasks, stop)
+                if task is None:
+                    break
+                filepath, language = task
+                try:
+                    response = parser.parse(filepath, language=language, timeout=self.timeout)
+                except Exception:
+                    self._log.exception("While parsing %s", filepath)
+                    response = None
+                if response is None or response.uast is None:
+                    if response is not None:
+                        self._log.warning("%s was skipped: %s", filepath, response.errors)
+                    with self._lock:
+                        self.failed += 1
+                    continue
+                with self._lock:
+                    self.parsed += 1
+                if not _put(parsed, (filepath, response.uast.SerializeToString()), stop):
+                    break
+        except Exception as e:
+            # e.g. the parser cannot connect, iter_samples() re-raises it
+            errors.append(e)
+        finally:
+            _put(parsed, None, stop)
+
+    def _feed(self, files, tasks, stop):
+        try:
+            for task in files:
+                if not _put(tasks, task, stop):
+                    return
+        finally:
+            for _ in range(self.in_flight):
+                _put(tasks, None, stop)
+
+    def _result(self, future):
+        samples, failed = future.result()
+        with self._lock:
+            self.failed += failed
+        return samples
+
+    def iter_samples(self, files):
+        """
+        :param files: iterable of (filepath, language), e.g. find_files()
+        :return: generator of (X, y_text, y_pos, y_uast) batch by batch in the order the \
+                 batches were submitted - a slow batch holds back the finished ones behind it
+        """
+        stop = threading.Event()
+        errors = []
+        tasks = queue.Queue(self.in_flight)
+        parsed = queue.Queue(self.batch_size * self.max_batches)
+        threads = [threading.Thread(target=self._parse_loop,
+                                    args=(tasks, parsed, stop, errors),
+                                    name="parse@%d" % i, daemon=True)
+                   for i in range(self.in_flight)]
+        threads.append(threading.Thread(target=self._feed, args=(files, tasks, stop),
+                                        name="feed", daemon=True))
+        pending = deque()
+        # grpc threads of the parser hang forked children
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(self.processes, mp_context=context) as pool:
+            try:
+                for thread in threads:
+                    thread.start()
+                finished = 0
+                batch = []
+                while finished < self.in_flight:
+                    item = parsed.get()
+                    if item is None:
+                        if errors:
+                            raise errors[0]
+                        finished += 1
+                        if finished < self.in_flight:
+                            continue
+                    else:
+                        batch.append(item)
+                        if len(batch) < self.batch_size:
+                            continue
+                    if batch:
+                        pending.append(pool.submit(crop_batch, batch, self.mask))
+                        batch = []
+                    while pending and (len(pending) >= self.max_batches or pending[0].done()):
+                        yield from self._result(pending.popleft())
+                while pending:
+                    yield from self._result(pending.popleft())
+            finally:
+                stop.set()
+                for future in pending:
+                    future.cancel()
+                for thread in threads:
+                    thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel code cropping of local repositories")
+    parser.add_argument("input", nargs="+", help="files and directories to crop")
+    parser.add_argument("--parser", default="local", choices=("local", "bblfsh"))
+    parser.add_argument("--bblfsh", default="0.0.0.0:9432", help="bblfsh server endpoint")
+    parser.add_argument("--latency", default=0, type=float,
+                        help="seconds added to each request of the local parser")
+    parser.add_argument("--roles", default="FUNCTION_DECLARATION",
+                        help="comma separated role names to crop")
+    parser.add_argument("--in-flight", default=8, type=int, help="concurrent parse requests")
+    parser.add_argument("--processes", default=None, type=int, help="cropping processes")
+    parser.add_argument("--batch-size", default=16, type=int, help="files per cropping task")
+    parser.add_argument("--output", help="write the samples as shards to this directory")
+    parser.add_argument("--shard-size", default=10000, type=int)
+    args = parser.parse_args()
+
+    languages = ("Python",) if args.parser == "local" else tuple(LANGUAGES.values())
+    cropper = ParallelCropper(make_parser_factory(args.parser, args.bblfsh, args.latency),
+                              roles=[get_role_id(role) for role in args.roles.split(",")],
+                              in_flight=args.in_flight, processes=args.processes,
+                              batch_size=args.batch_size)
+    writer = CodeCropperShardWriter(args.output, args.shard_size) if args.output else None
+    start = time.time()
+    samples = 0
+    for sample in cropper.iter_samples(find_files(args.input, languages)):
+        samples += 1
+        if writer is not None:
+            writer.add(*sample)
+    if writer is not None:
+        writer.close()
+    elapsed = time.time() - start
+    print("%d files, %d failed, %d samples in %.2fs: %.1f files/s, %.1f samples/s" % (
+        cropper.parsed, cropper.failed, samples, elapsed, cropper.parsed / elapsed,
+        samples / elapsed))
+
+
+if __name__ == "__main__":
+    main()
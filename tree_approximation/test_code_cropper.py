@@ -0,0 +1,223 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+from code_cropper import CodeCropperBaseModel, CodeCropperRoles, CodeCropperShardReader, \
+    CodeCropperShardWriter, FOR_EACH, FUNCTION_DECLARATION, LazyUASTs, SIMPLE_IDENTIFIER, \
+    SourceFile, iter_nodes, match_roles, role_mask
+from pipeline import LocalParser, ParallelCropper, crop_batch, find_files, make_parser_factory
+
+
+def make_uast(internal_type, token):
+    from bblfsh.github.com.bblfsh.sdk.uast.generated_pb2 import Node
+    node = Node()
+    node.internal_type = internal_type
+    node.token = token
+    return node
+
+
+def add_child(parent, token, roles=(), line=1):
+    node = parent.children.add()
+    node.token = token
+    node.roles.extend(roles)
+    node.start_position.line = node.end_position.line = line
+    node.start_position.col, node.end_position.col = 1, 2
+    return node
+
+
+class RolesTests(unittest.TestCase):
+    def setUp(self):
+        # f(for (x) {}), g(y) - the tokens are in pre-order
+        self.root = make_uast("File", "root")
+        f = add_child(self.root, "f", [FUNCTION_DECLARATION])
+        loop = add_child(f, "for", [FOR_EACH])
+        add_child(loop, "x", [SIMPLE_IDENTIFIER])
+        add_child(f, "body")
+        g = add_child(self.root, "g", [FUNCTION_DECLARATION, SIMPLE_IDENTIFIER])
+        add_child(g, "y", [SIMPLE_IDENTIFIER])
+
+    def test_role_mask(self):
+        self.assertEqual(role_mask([]), 0)
+        self.assertEqual(role_mask([FOR_EACH, FUNCTION_DECLARATION, FOR_EACH]),
+                         (1 << FOR_EACH) | (1 << FUNCTION_DECLARATION))
+
+    def test_iter_nodes_pre_order(self):
+        self.assertEqual([node.token for node in iter_nodes(self.root)],
+                         ["root", "f", "for", "x", "body", "g", "y"])
+
+    def test_deep_chain(self):
+        depth = sys.getrecursionlimit() * 2
+        root = node = make_uast("File", "0")
+        for i in range(1, depth):
+            node = add_child(node, str(i), [FUNCTION_DECLARATION], line=i)
+        self.assertEqual([node.token for node in iter_nodes(root)],
+                         [str(i) for i in range(depth)])
+        matches = list(match_roles(root, role_mask([FUNCTION_DECLARATION])))
+        self.assertEqual(len(matches), depth - 1)
+        self.assertEqual(matches[-1][1], [depth - 2, 0, depth - 2, 1])
+
+    def test_match_roles(self):
+        matched = [(mask, node.token) for mask, _, node in
+                   match_roles(self.root, role_mask([FUNCTION_DECLARATION, FOR_EACH]))]
+        self.assertEqual(matched, [(1 << FUNCTION_DECLARATION, "f"), (1 << FOR_EACH, "for"),
+                                   (1 << FUNCTION_DECLARATION, "g")])
+
+    def test_find_positions_by_role(self):
+        cropper = CodeCropperRoles(roles=(FUNCTION_DECLARATION, FOR_EACH, SIMPLE_IDENTIFIER))
+        positions = {role: [node.token for _, node in nodes]
+                     for role, nodes in cropper.find_positions_by_role(self.root).items()}
+        self.assertEqual(positions, {FUNCTION_DECLARATION: ["f", "g"], FOR_EACH: ["for"],
+                                     SIMPLE_IDENTIFIER: ["x", "g", "y"]})
+        self.assertEqual([node.token for _, node in cropper.find_positions(self.root)],
+                         ["f", "for", "x", "g", "y"])
+
+
+class CodeCropperBaseModelTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.uasts = [make_uast("FunctionDef", "f%d" % i) for i in range(5)]
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def save_load(self, model, name="model.asdf"):
+        path = os.path.join(self.dir.name, name)
+        model.save(path)
+        return CodeCropperBaseModel().load(source=path)
+
+    def test_y_uast_round_trip(self):
+        model = self.save_load(CodeCropperBaseModel().construct(
+            X=["x%d" % i for i in range(5)], y_text=["t%d" % i for i in range(5)],
+            y_pos=[[i, 0, i, 1] for i in range(5)], y_uast=self.uasts))
+        self.assertIsInstance(model.y_uast, LazyUASTs)
+        self.assertEqual(len(model.y_uast), 5)
+        self.assertEqual(model.y_uast[2].token, "f2")
+        self.assertEqual(model.y_uast[-1].token, "f4")
+        self.assertEqual([uast.token for uast in model.y_uast[1:3]], ["f1", "f2"])
+        with self.assertRaises(IndexError):
+            model.y_uast[5]
+        # a loaded model is saved again without deserializing the UASTs
+        model = self.save_load(model, "again.asdf")
+        self.assertEqual([uast.token for uast in model.y_uast], ["f%d" % i for i in range(5)])
+
+    def test_y_uast_cache(self):
+        CodeCropperBaseModel.UAST_CACHE_SIZE = 2
+        try:
+            model = self.save_load(CodeCropperBaseModel().construct(
+                X=["x"] * 5, y_text=["t"] * 5, y_pos=[[0, 0, 0, 1]] * 5, y_uast=self.uasts))
+        finally:
+            CodeCropperBaseModel.UAST_CACHE_SIZE = 0
+        first = model.y_uast[0]
+        self.assertIs(model.y_uast[0], first)
+        model.y_uast[1]
+        model.y_uast[2]
+        # the least recently used entry was evicted and is deserialized again
+        self.assertIsNot(model.y_uast[0], first)
+
+    def test_spans_round_trip(self):
+        with open(os.path.join(self.dir.name, "a.py"), "w", encoding="utf-8") as f:
+            f.write("def f():\n    return 'é'\n\ndef g(): pass\n")
+        source = SourceFile.read(os.path.join(self.dir.name, "a.py"))
+        spans = [(0,) + source.span(pos) for pos in ([0, 0, 1, 13], [3, 0, 3, 12])]
+        model = self.save_load(CodeCropperBaseModel().construct(
+            files=["a.py"], spans=spans, y_pos=[[0, 0, 1, 13], [3, 0, 3, 12]],
+            y_uast=self.uasts[:2], root=self.dir.name))
+        self.assertEqual(model.root, self.dir.name)
+        self.assertEqual(list(model.y_text), ["def f():\n    return 'é'", "def g(): pass"])
+        self.assertEqual(model.X[1], "def f():\n    return 'é'\n\n\n")
+
+
+class CodeCropperShardTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_round_trip(self):
+        output = os.path.join(self.dir.name, "shards")
+        with CodeCropperShardWriter(output, shard_size=2) as writer:
+            for i in range(5):
+                writer.add("x%d" % i, "t%d" % i, [i, 0, i, 1], make_uast("FunctionDef", "f%d" % i))
+            # the full shards are written as they fill up
+            self.assertEqual(len(writer.shards), 2)
+        # close() flushed the partial last shard
+        self.assertEqual([shard["samples"] for shard in writer.shards], [2, 2, 1])
+        self.assertEqual(sorted(os.listdir(output)),
+                         ["00000.asdf", "00001.asdf", "00002.asdf", "manifest.json"])
+        reader = CodeCropperShardReader(output)
+        self.assertEqual(len(reader), 5)
+        self.assertEqual(reader.manifest["shard_size"], 2)
+        self.assertEqual([len(model.X) for model in reader.shards()], [2, 2, 1])
+        samples = list(CodeCropperShardReader(os.path.join(output, "manifest.json")))
+        self.assertEqual([X for X, _, _, _ in samples], ["x%d" % i for i in range(5)])
+        self.assertEqual([y_text for _, y_text, _, _ in samples], ["t%d" % i for i in range(5)])
+        self.assertEqual([list(y_pos) for _, _, y_pos, _ in samples],
+                         [[i, 0, i, 1] for i in range(5)])
+        self.assertEqual([uast.token for _, _, _, uast in samples],
+                         ["f%d" % i for i in range(5)])
+
+
+class SourceFileTests(unittest.TestCase):
+    def test_columns_are_characters(self):
+        source = SourceFile("s = 'ü' + 'ß'\nt = s\n")
+        self.assertEqual(source.snippet(*source.span([0, 10, 0, 12])), "'ß'")
+        self.assertEqual(source.crop(*source.span([0, 10, 0, 12])), "s = 'ü' + \nt = s\n")
+        self.assertEqual(source.snippet(*source.span([1, 4, 1, 4])), "s")
+
+
+class ParallelCropperTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.write("a.py", "def f(ä):\n    return ä\n\ndef g():\n    pass\n")
+        self.write("b.py", "def h(:\n")
+        self.write("c.py", "x = 1\n")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name, text):
+        with open(os.path.join(self.dir.name, name), "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def test_iter_samples(self):
+        cropper = ParallelCropper(make_parser_factory("local"), in_flight=2, processes=1,
+                                  batch_size=2)
+        samples = list(cropper.iter_samples(find_files([self.dir.name])))
+        self.assertEqual(sorted(sample[1] for sample in samples),
+                         ["def f(ä):\n    return ä", "def g():\n    pass"])
+        X = {y_text: X for X, y_text, _, _ in samples}
+        self.assertEqual(X["def f(ä):\n    return ä"], "\n\ndef g():\n    pass\n")
+        # b.py is a syntax error
+        self.assertEqual((cropper.parsed, cropper.failed), (2, 1))
+
+    def test_crop_batch_skips_errors(self):
+        path = os.path.join(self.dir.name, "a.py")
+        uast = LocalParser().parse(path).uast.SerializeToString()
+        samples, failed = crop_batch([(path + ".missing", uast), (path, uast)],
+                                     ParallelCropper(None).mask)
+        self.assertEqual((len(samples), failed), (2, 1))
+
+    def test_close(self):
+        for i in range(20):
+            self.write("d%02d.py" % i, "def f%d():\n    pass\n" % i)
+        cropper = ParallelCropper(make_parser_factory("local"), in_flight=2, processes=1,
+                                  batch_size=1, max_batches=1)
+        samples = cropper.iter_samples(find_files([self.dir.name]))
+        next(samples)
+        samples.close()
+        self.assertFalse([thread.name for thread in threading.enumerate()
+                          if thread.name.startswith("parse@") or thread.name == "feed"])
+
+    def test_parser_factory_error(self):
+        def factory():
+            raise ConnectionError("no server")
+        cropper = ParallelCropper(factory, in_flight=2, processes=1)
+        with self.assertRaises(ConnectionError):
+            list(cropper.iter_samples(find_files([self.dir.name])))
+
+
+if __name__ == "__main__":
+    unittest.main()
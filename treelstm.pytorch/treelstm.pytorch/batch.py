@@ -0,0 +1,228 @@
+from collections import deque
+import queue
+import threading
+
+import torch
+import torch.utils.data as data
+
+from tree import ArrayTree
+from utils import map_label_to_target
+
+
+# mini-batch of trees scheduled by node heights for ChildSumTreeLSTM.forward_batch
+class TreeBatch(object):
+    """
+    The nodes of all the trees are renumbered so that the nodes of the same height
+    (leaves first) occupy a contiguous range; every level is then computed at once.
+    For each level, the children are grouped by the level of their parents so that
+    their contributions can be scattered into the parents with a single index_add.
+    """
+    def __init__(self, tokens, parents, heights, roots):
+        """
+        :param tokens: token id of each node.
+        :param parents: parent of each node, -1 for the roots.
+        :param heights: height of each node, 0 for the leaves.
+        :param roots: root node of each tree, in the order of the trees.
+        """
+        num_nodes = len(tokens)
+        self.num_trees = len(roots)
+        self.num_nodes = num_nodes
+        # evaluation without the autograd history
+        self.volatile = False
+        order = sorted(range(num_nodes), key=heights.__getitem__)
+        new_id = [0] * num_nodes
+        for pos, node in enumerate(order):
+            new_id[node] = pos
+        num_levels = max(heights) + 1 if num_nodes else 0
+        offsets = [0] * (num_levels + 1)
+        for height in heights:
+            offsets[height + 1] += 1
+        for level in range(num_levels):
+            offsets[level + 1] += offsets[level]
+        self.offsets = offsets
+
+        self.tokens = torch.LongTensor([tokens[node] for node in order])
+
+        groups = [dict() for _ in range(num_levels)]
+        for node in order:
+            parent = parents[node]
+            if parent < 0:
+                continue
+            level, plevel = heights[node], heights[parent]
+            child_pos, parent_pos, parent_ids = groups[level].setdefault(plevel, ([], [], []))
+            child_pos.append(new_id[node] - offsets[level])
+            parent_pos.append(new_id[parent] - offsets[plevel])
+            parent_ids.append(new_id[parent])
+        # children[level] = [(parent level, child positions, parent positions, parent ids)]
+        self.children = [[(plevel, torch.LongTensor(child_pos), torch.LongTensor(parent_pos),
+                           torch.LongTensor(parent_ids))
+                          for plevel, (child_pos, parent_pos, parent_ids)
+                          in sorted(group.items())]
+                         for group in groups]
+
+        root_levels = [[] for _ in range(num_levels)]
+        for tree, root in enumerate(roots):
+            root_levels[heights[root]].append((new_id[root] - offsets[heights[root]], tree))
+        concat_order = [tree for level in root_levels for _, tree in level]
+        permutation = [0] * self.num_trees
+        for pos, tree in enumerate(concat_order):
+            permutation[tree] = pos
+        # roots[level] = positions of the roots inside the level
+        self.roots = [torch.LongTensor([pos for pos, _ in level]) if level else None
+                      for level in root_levels]
+        self.root_order = torch.LongTensor(permutation)
+
+    def __len__(self):
+        return self.num_trees
+
+    @property
+    def num_levels(self):
+        return len(self.offsets) - 1
+
+    def cuda(self):
+        self.tokens = self.tokens.cuda()
+        self.children = [[(plevel, child_pos.cuda(), parent_pos.cuda(), parent_ids.cuda())
+                          for plevel, child_pos, parent_pos, parent_ids in level]
+                         for level in self.children]
+        self.roots = [pos.cuda() if pos is not None else None for pos in self.roots]
+        self.root_order = self.root_order.cuda()
+        return self
+
+    @classmethod
+    def from_trees(cls, trees, sentences):
+        """
+        Flattens the trees without recursion.
+
+        :param trees: list of tree.Tree roots or tree.ArrayTree-s.
+        :param sentences: list of LongTensor-s with the token ids, node.idx indexes them.
+        """
+        tokens, parents, heights, roots = [], [], [], []
+        for root, sentence in zip(trees, sentences):
+            base = len(tokens)
+            if isinstance(root, ArrayTree):
+                tokens.extend(sentence.index_select(0, root.idx).tolist())
+                parents.extend(p + base if p >= 0 else -1 for p in root.parents.tolist())
+                heights.extend(root.heights.tolist())
+                roots.append(base)
+                continue
+            nodes = []
+            queue = deque([(root, -1)])
+            while queue:
+                node, parent = queue.popleft()
+                pos = base + len(nodes)
+                nodes.append(node)
+                tokens.append(int(sentence[node.idx]))
+                parents.append(parent)
+                heights.append(0)
+                queue.extend((child, pos) for child in node.children)
+            # breadth first order: the children always follow their parents
+            for pos in range(len(tokens) - 1, base, -1):
+                parent = parents[pos]
+                heights[parent] = max(heights[parent], heights[pos] + 1)
+            roots.append(base)
+        return cls(tokens, parents, heights, roots)
+
+
+class PairCollator(object):
+    """
+    DataLoader collate_fn which turns a list of SICKDataset samples into
+    (left TreeBatch, right TreeBatch, targets, labels).
+    """
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+
+    def __call__(self, samples):
+        ltrees, lsents, rtrees, rsents, labels = zip(*samples)
+        targets = torch.cat([map_label_to_target(label, self.num_classes) for label in labels], 0)
+        return (TreeBatch.from_trees(ltrees, lsents), TreeBatch.from_trees(rtrees, rsents),
+                targets, torch.Tensor([float(label) for label in labels]))
+
+
+class BucketSampler(data.Sampler):
+    """
+    Batch sampler which puts pairs of similar size into the same mini-batch so that the
+    levels of the batched trees are well filled. The indices are shuffled, split into pools
+    of pool_size batches, sorted by size inside each pool and the batches are shuffled.
+    """
+    def __init__(self, sizes, batch_size, indices=None, pool_size=50):
+        """
+        :param sizes: size of every sample of the dataset.
+        :param batch_size: number of samples in a mini-batch.
+        :param indices: optional subset of the dataset to sample.
+        """
+        self.sizes = sizes
+        self.batch_size = batch_size
+        self.indices = list(indices) if indices is not None else list(range(len(sizes)))
+        self.pool_size = pool_size
+
+    def __iter__(self):
+        order = [self.indices[i] for i in torch.randperm(len(self.indices)).tolist()]
+        pool = self.batch_size * self.pool_size
+        batches = []
+        for start in range(0, len(order), pool):
+            chunk = sorted(order[start:start + pool], key=self.sizes.__getitem__)
+            batches.extend(chunk[i:i + self.batch_size]
+                           for i in range(0, len(chunk), self.batch_size))
+        for i in torch.randperm(len(batches)).tolist():
+            yield batches[i]
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+
+def pair_sizes(dataset):
+    """
+    :return: number of nodes in both trees of every pair of the dataset.
+    """
+    def size(tree, sentence):
+        return tree.size() if isinstance(tree, ArrayTree) else len(sentence)
+    return [size(ltree, lsent) + size(rtree, rsent) for ltree, lsent, rtree, rsent
+            in zip(dataset.ltrees, dataset.lsentences, dataset.rtrees, dataset.rsentences)]
+
+
+class Prefetcher(object):
+    """
+    Iterates over the items of a generator which a background thread prepares ahead, at most
+    depth of them wait in the queue. The exceptions of the generator are raised by the
+    iteration; close() stops the thread when the iteration ends early.
+    """
+    _END = object()
+
+    def __init__(self, items, depth):
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._fill, args=(items,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self, items):
+        try:
+            for item in items:
+                if not self._put((None, item)):
+                    return
+        except Exception as e:
+            self._put((e, None))
+            return
+        self._put((None, self._END))
+
+    def __iter__(self):
+        while True:
+            error, item = self.queue.get()
+            if error is not None:
+                raise error
+            if item is self._END:
+                return
+            yield item
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
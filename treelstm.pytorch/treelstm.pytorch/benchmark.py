@@ -0,0 +1,240 @@
+"""
+Micro-benchmarks of ChildSumTreeLSTM and SimilarityTreeLSTM on synthetic trees of
+controlled size and shape, on CPU.
+
+Every case times the encoder forward pass, the forward and backward passes and a full
+SimilarityTreeLSTM training step, both node by node and level batched. The results are
+written as JSON and compared against a baseline file from an earlier run:
+
+    python benchmark.py --output before.json
+    python benchmark.py --baseline before.json --tolerance 0.1
+"""
+from __future__ import print_function
+import argparse
+import json
+import random
+import sys
+import time
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.autograd import Variable as Var
+
+from batch import TreeBatch
+from model import SimilarityTreeLSTM
+from tree import ArrayTree
+from utils import map_label_to_target
+
+SHAPES = ('chain', 'star', 'balanced', 'random')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='TreeLSTM micro-benchmarks')
+    parser.add_argument('--shapes', default=','.join(SHAPES),
+                        help='comma separated tree shapes: ' + ', '.join(SHAPES))
+    parser.add_argument('--sizes', default='16,64,256', help='comma separated node counts')
+    parser.add_argument('--branching', default='2,8',
+                        help='comma separated branching factors of the balanced trees')
+    parser.add_argument('--modes', default='node,level',
+                        help='node - one tree at a time with the iterative ArrayTree forward, '
+                             'level - forward_batch')
+    parser.add_argument('--batch', default=16, type=int, help='trees per level batched pass')
+    parser.add_argument('--repeat', default=5, type=int, help='timed repetitions of each case')
+    parser.add_argument('--warmup', default=1, type=int)
+    parser.add_argument('--in-dim', default=300, type=int)
+    parser.add_argument('--mem-dim', default=150, type=int)
+    parser.add_argument('--hidden-dim', default=50, type=int)
+    parser.add_argument('--vocab', default=1000, type=int)
+    parser.add_argument('--fused', action='store_true')
+    parser.add_argument('--threads', default=1, type=int, help='torch threads, 0 keeps default')
+    parser.add_argument('--seed', default=123, type=int)
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--baseline', help='compare with the JSON results of an earlier run, '
+                        'exit with 1 if a case fails which ran in the baseline')
+    parser.add_argument('--tolerance', default=0.0, type=float,
+                        help='exit with 1 if a case is slower than the baseline by more than '
+                             'this fraction, 0 disables')
+    return parser.parse_args()
+
+
+def make_parents(shape, size, branching, rng):
+    """
+    :return: 1-based parents of the tokens as in the *.parents files, 0 is the root.
+    """
+    if shape == 'chain':
+        parents = [0] + list(range(1, size))
+    elif shape == 'star':
+        parents = [0] + [1] * (size - 1)
+    elif shape == 'balanced':
+        parents = [0] + [(i - 1) // branching + 1 for i in range(1, size)]
+    elif shape == 'random':
+        parents = [0] + [rng.randint(1, i) for i in range(1, size)]
+    else:
+        raise ValueError('Unknown tree shape: %s' % shape)
+    # the token order does not follow the tree in real sentences
+    order = list(range(size))
+    rng.shuffle(order)
+    position = {node: pos for pos, node in enumerate(order)}
+    shuffled = [0] * size
+    for node, parent in enumerate(parents):
+        shuffled[position[node]] = position[parent - 1] + 1 if parent else 0
+    return shuffled
+
+
+def make_cases(args):
+    cases = []
+    for shape in args.shapes.split(','):
+        for size in map(int, args.sizes.split(',')):
+            branchings = list(map(int, args.branching.split(','))) if shape == 'balanced' \
+                else [None]
+            for branching in branchings:
+                cases.append((shape, size, branching))
+    return cases
+
+
+def timed(func, repeat, warmup):
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    times.sort()
+    return {'min_ms': times[0] * 1000, 'median_ms': times[len(times) // 2] * 1000}
+
+
+def run_case(args, model, criterion, optimizer, shape, size, branching, mode):
+    rng = random.Random('%d-%s-%d-%s' % (args.seed, shape, size, branching))
+    trees, sentences = [], []
+    for _ in range(2 * args.batch):
+        trees.append(ArrayTree.from_parents(make_parents(shape, size, branching or 2, rng)))
+        sentences.append(torch.LongTensor([rng.randrange(args.vocab) for _ in range(size)]))
+    labels = [rng.uniform(1, 5) for _ in range(args.batch)]
+    target = Var(torch.cat([map_label_to_target(label, 5) for label in labels], 0))
+    encoder = model.childsumtreelstm
+    half = args.batch
+
+    if mode == 'level':
+        def encode():
+            return encoder.forward_batch(TreeBatch.from_trees(trees[:half], sentences[:half]))
+
+        def step_output():
+            return model.forward_batch(TreeBatch.from_trees(trees[:half], sentences[:half]),
+                                       TreeBatch.from_trees(trees[half:], sentences[half:]))
+    elif mode == 'node':
+        def encode():
+            states = [encoder(tree, Var(sentence)) for tree, sentence
+                      in zip(trees[:half], sentences[:half])]
+            return torch.cat([c for c, _ in states], 0), torch.cat([h for _, h in states], 0)
+
+        def step_output():
+            return torch.cat([model(trees[i], Var(sentences[i]), trees[half + i],
+                                    Var(sentences[half + i])) for i in range(half)], 0)
+    else:
+        raise ValueError('Unknown mode: %s' % mode)
+
+    def forward():
+        model.eval()
+        encode()
+
+    def backward():
+        model.train()
+        c, h = encode()
+        (c.sum() + h.sum()).backward()
+        model.zero_grad()
+
+    def step():
+        model.train()
+        optimizer.zero_grad()
+        criterion(step_output(), target).backward()
+        optimizer.step()
+
+    result = {}
+    for name, func in (('forward', forward), ('backward', backward), ('step', step)):
+        result[name] = timed(func, args.repeat, args.warmup)
+    nodes = half * size
+    result['nodes_per_second'] = nodes / (result['backward']['median_ms'] / 1000.0) \
+        if result['backward']['median_ms'] > 0 else 0
+    result['depth'] = max(tree.depth() for tree in trees)
+    return result
+
+
+def run(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    model = SimilarityTreeLSTM(False, args.vocab, args.in_dim, args.mem_dim, args.hidden_dim, 5,
+                               False, args.fused)
+    criterion = nn.KLDivLoss()
+    optimizer = optim.Adagrad(model.parameters(), lr=0.01)
+    results = {}
+    for shape, size, branching in make_cases(args):
+        for mode in args.modes.split(','):
+            key = '%s/%d%s/%s' % (shape, size, '/b%d' % branching if branching else '', mode)
+            try:
+                results[key] = run_case(args, model, criterion, optimizer, shape, size,
+                                        branching, mode)
+            except Exception as e:
+                results[key] = {'error': '%s: %s' % (type(e).__name__, e)}
+            print('%-28s %s' % (key, format_result(results[key])))
+            sys.stdout.flush()
+    return {
+        'config': {k: v for k, v in vars(args).items()
+                   if k not in ('output', 'baseline', 'tolerance')},
+        'torch': torch.__version__,
+        'results': results,
+    }
+
+
+def format_result(result):
+    if 'error' in result:
+        return result['error']
+    return 'forward %9.2fms  backward %9.2fms  step %9.2fms  %10.0f nodes/s' % (
+        result['forward']['median_ms'], result['backward']['median_ms'],
+        result['step']['median_ms'], result['nodes_per_second'])
+
+
+def compare(report, baseline, tolerance):
+    """
+    :return: list of the cases which became slower than the tolerance allows or fail while
+             the baseline ran them.
+    """
+    regressions = []
+    for key, result in sorted(report['results'].items()):
+        base = baseline['results'].get(key)
+        if base is None or 'error' in base:
+            continue
+        if 'error' in result:
+            print('%-28s failed: %s' % (key, result['error']))
+            regressions.append('%s failed' % key)
+            continue
+        ratios = []
+        for name in ('forward', 'backward', 'step'):
+            ratio = result[name]['median_ms'] / base[name]['median_ms'] \
+                if base[name]['median_ms'] > 0 else float('nan')
+            ratios.append('%s x%.2f' % (name, ratio))
+            if tolerance and ratio > 1 + tolerance:
+                regressions.append('%s %s' % (key, name))
+        print('%-28s %s' % (key, '  '.join(ratios)))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print('Regressions against the baseline: ' + ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+from collections import OrderedDict, deque
+
+import torch
+from torch.autograd import Variable as Var
+
+from batch import TreeBatch
+from tree import ArrayTree
+from utils import no_grad
+
+
+def tree_key(tree, sentence):
+    """
+    :return: hashable key which is the same for the trees with the same structure and tokens.
+    """
+    if isinstance(tree, ArrayTree):
+        return (tuple(tree.parents.tolist()),
+                tuple(sentence.index_select(0, tree.idx).tolist()))
+    parents, tokens = [], []
+    queue = deque([(tree, -1)])
+    while queue:
+        node, parent = queue.popleft()
+        pos = len(tokens)
+        parents.append(parent)
+        tokens.append(int(sentence[node.idx]))
+        queue.extend((child, pos) for child in node.children)
+    return tuple(parents), tuple(tokens)
+
+
+# root states of the trees reused between the pairs during evaluation
+class EncodingCache(object):
+    """
+    Every unique tree is encoded by the ChildSumTreeLSTM once. The entries are dropped as soon
+    as the version of the model parameters changes, see SimilarityTreeLSTM.version, and the
+    least recently used ones beyond max_size are evicted.
+    """
+    def __init__(self, model, max_size=50000):
+        """
+        :param model: SimilarityTreeLSTM
+        :param max_size: maximum number of the cached trees, 0 means unbounded.
+        """
+        self.model = model
+        self.max_size = max_size
+        self.version = None
+        self.states = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def clear(self):
+        self.states = OrderedDict()
+        self.version = self.model.version
+
+    def encode(self, trees, sentences):
+        """
+        :return: (c, h) tensors of the roots, each of shape (number of trees, mem_dim)
+        """
+        if self.version != self.model.version:
+            self.clear()
+        keys = [tree_key(tree, sentence) for tree, sentence in zip(trees, sentences)]
+        missing = {}
+        for key, tree, sentence in zip(keys, trees, sentences):
+            if key not in self.states and key not in missing:
+                missing[key] = (tree, sentence)
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        if missing:
+            batch = TreeBatch.from_trees([tree for tree, _ in missing.values()],
+                                         [sentence for _, sentence in missing.values()])
+            batch.volatile = True
+            if self.model.cuda_flag:
+                batch.cuda()
+            with no_grad():
+                c, h = self.model.childsumtreelstm.forward_batch(batch)
+            for i, key in enumerate(missing):
+                self.states[key] = (c.data[i], h.data[i])
+        for key in keys:
+            self.states.move_to_end(key)
+        states = (torch.stack([self.states[key][0] for key in keys]),
+                  torch.stack([self.states[key][1] for key in keys]))
+        # evicted only now, the trees of this batch may outnumber max_size
+        while self.max_size and len(self.states) > self.max_size:
+            self.states.popitem(last=False)
+        return states
+
+    def forward(self, ltrees, lsents, rtrees, rsents):
+        """
+        SimilarityTreeLSTM.forward_batch() over the cached states of the left and right trees.
+        """
+        n = len(ltrees)
+        c, _ = self.encode(list(ltrees) + list(rtrees), list(lsents) + list(rsents))
+        with no_grad():
+            return self.model.similarity(Var(c[:n], volatile=True), Var(c[n:], volatile=True))
+
+
+class VersionedOptimizer(object):
+    """
+    Bumps the version of the model after every step() and flush() of the optimizer, so
+    EncodingCache never returns the states encoded with the parameters before the update.
+    The optimizers change the parameters through .data, which the autograd version counters
+    of the parameters do not see.
+    """
+    def __init__(self, optimizer, model):
+        """
+        :param optimizer: torch optimizer or sparse.SparseAwareOptimizer.
+        :param model: SimilarityTreeLSTM whose parameters the optimizer updates.
+        """
+        self.optimizer = optimizer
+        self.model = model
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    def prepare(self, indices):
+        if hasattr(self.optimizer, 'prepare'):
+            self.optimizer.prepare(indices)
+            self.model.bump_version()
+
+    def step(self):
+        self.optimizer.step()
+        self.model.bump_version()
+
+    def flush(self):
+        if hasattr(self.optimizer, 'flush'):
+            self.optimizer.flush()
+        self.model.bump_version()
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.optimizer.load_state_dict(state_dict)
@@ -15,7 +15,39 @@ def parse_args():
                                                                              'rate')
     parser.add_argument('--wd', default=1e-4, type=float, help='weight decay (default: 1e-4)')
     parser.add_argument('--sparse', action='store_true',
-                        help='Enable sparsity for embeddings, incompatible with weight decay')
+                        help='Enable sparsity for embeddings, their weight decay is applied lazily')
+    parser.add_argument('--batched', action='store_true',
+                        help='Compute all the tree nodes of the same height at once')
+    parser.add_argument('--minibatch', action='store_true',
+                        help='One forward and backward pass per batch of similar sized trees')
+    parser.add_argument('--fused', action='store_true',
+                        help='Fuse the TreeLSTM gate projections into fewer matmuls')
+    parser.add_argument('--processes', default=1, type=int,
+                        help='number of Hogwild training processes (default: 1)')
+    parser.add_argument('--prefetch', default=0, type=int,
+                        help='prepare this many samples or mini-batches ahead in a background '
+                             'thread, 0 disables')
+    parser.add_argument('--loader-workers', default=0, type=int,
+                        help='number of processes which collate the --minibatch batches')
+    parser.add_argument('--eval-batchsize', default=256, type=int,
+                        help='number of pairs evaluated at once (default: 256)')
+    parser.add_argument('--eval-workers', default=0, type=int,
+                        help='number of processes which prepare the evaluation batches')
+    parser.add_argument('--eval-cache', action='store_true',
+                        help='encode every unique tree only once during the evaluation')
+    parser.add_argument('--eval-cache-size', default=50000, type=int,
+                        help='maximum number of trees in the --eval-cache, 0 means unbounded '
+                             '(default: 50000)')
+    parser.add_argument('--eval-every', default=1, type=int,
+                        help='evaluate every N epochs and after the last one (default: 1)')
+    parser.add_argument('--train-eval-samples', default=0, type=int,
+                        help='evaluate on a fixed random subset of the train set of this size, '
+                             '0 for the whole set')
+    parser.add_argument('--profile', default=None,
+                        help='append per phase timings, nodes per second and peak memory of '
+                             'every epoch to this JSON lines file')
+    parser.add_argument('--profile-steps', default=0, type=int,
+                        help='capture the first N optimizer steps with the autograd profiler')
     parser.add_argument('--optim', default='adagrad', help='optimizer (default: adagrad)')
     parser.add_argument('--seed', default=123, type=int, help='random seed (default: 123)')
     cuda_parser = parser.add_mutually_exclusive_group(required=False)
@@ -1,12 +1,14 @@
 from copy import deepcopy
+import json
 import os
 
+import numpy
 import torch
 import torch.utils.data as data
 from tqdm import tqdm
 
 import Constants
-from tree import Tree
+from tree import ArrayTree
 from vocab import Vocab
 
 
@@ -31,11 +33,14 @@ class SICKDataset(data.Dataset):
         return self.size
 
     def __getitem__(self, index):
-        ltree = deepcopy(self.ltrees[index])
-        rtree = deepcopy(self.rtrees[index])
-        lsent = deepcopy(self.lsentences[index])
-        rsent = deepcopy(self.rsentences[index])
-        label = deepcopy(self.labels[index])
+        ltree = self.ltrees[index]
+        rtree = self.rtrees[index]
+        # the array trees are immutable, pointer trees from old caches get the states written
+        if not isinstance(ltree, ArrayTree):
+            ltree, rtree = deepcopy(ltree), deepcopy(rtree)
+        lsent = self.lsentences[index]
+        rsent = self.rsentences[index]
+        label = self.labels[index]
         return ltree, lsent, rtree, rsent, label
 
     def read_sentences(self, filename):
@@ -54,34 +59,7 @@ class SICKDataset(data.Dataset):
 
     @staticmethod
     def read_tree(line):
-        parents = list(map(int, line.split()))
-        trees = dict()
-        root = None
-        for i in range(1, len(parents) + 1):
-            # if not trees[i-1] and parents[i-1]!=-1:
-            if i - 1 not in trees.keys() and parents[i - 1] != -1:
-                idx = i
-                prev = None
-                while True:
-                    parent = parents[idx - 1]
-                    if parent == -1:
-                        break
-                    tree = Tree()
-                    if prev is not None:
-                        tree.add_child(prev)
-                    trees[idx - 1] = tree
-                    tree.idx = idx - 1
-                    # if trees[parent-1] is not None:
-                    if parent - 1 in trees.keys():
-                        trees[parent - 1].add_child(tree)
-                        break
-                    elif parent == 0:
-                        root = tree
-                        break
-                    else:
-                        prev = tree
-                        idx = parent
-        return root
+        return ArrayTree.from_parents(list(map(int, line.split())))
 
     @staticmethod
     def read_labels(filename):
@@ -89,3 +67,119 @@ class SICKDataset(data.Dataset):
             labels = list(map(lambda x: float(x), f.readlines()))
             labels = torch.Tensor(labels)
         return labels
+
+
+# variable length rows of a flat array, row i is values[offsets[i]:offsets[i + 1]]
+class RaggedColumn(object):
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        index = int(index)
+        return self.values[int(self.offsets[index]):int(self.offsets[index + 1])]
+
+
+# trees of one side stored column by column, the ArrayTree fields are views into them
+class TreeColumn(object):
+    def __init__(self, columns, offsets):
+        self.columns = columns
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        index = int(index)
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        idx, parents, postorder, heights = (self.columns[name][start:end] for name in (
+            'idx', 'parents', 'postorder', 'heights'))
+        # one more child offset per tree
+        child_offsets = self.columns['child_offsets'][start + index:end + index + 1]
+        # breadth first numbering: all the nodes but the root are children, in order
+        children = torch.arange(1, end - start).long()
+        return ArrayTree(idx, parents, child_offsets, children, postorder, heights)
+
+
+# memory mapped columnar version of SICKDataset
+class ColumnarSICKDataset(SICKDataset):
+    """
+    Every column is a flat int64 (float32 for the labels) .npy file inside the directory:
+    {l,r}tokens with {l,r}token_offsets hold the sentences; {l,r}idx, {l,r}parents,
+    {l,r}postorder, {l,r}heights with {l,r}node_offsets and {l,r}child_offsets hold the
+    ArrayTree-s. Nothing is read until a sample is accessed, the samples are views into
+    the copy on write memory maps.
+    """
+    tree_columns = ('idx', 'parents', 'postorder', 'heights', 'child_offsets')
+
+    def __init__(self, path):
+        data.Dataset.__init__(self)
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.num_classes = meta['num_classes']
+        self.vocab = None
+
+        def column(name):
+            return torch.from_numpy(numpy.load(os.path.join(path, name + '.npy'), mmap_mode='c'))
+
+        sides = {}
+        for side in 'lr':
+            tokens = RaggedColumn(column(side + 'tokens'), column(side + 'token_offsets'))
+            node_offsets = column(side + 'node_offsets')
+            trees = TreeColumn({name: column(side + name) for name in self.tree_columns},
+                               node_offsets)
+            sides[side] = tokens, trees, node_offsets
+        self.lsentences, self.ltrees, lnodes = sides['l']
+        self.rsentences, self.rtrees, rnodes = sides['r']
+        self.labels = column('labels')
+        self.size = self.labels.size(0)
+        # batch.pair_sizes() without touching the trees
+        self.pair_sizes = ((lnodes[1:] - lnodes[:-1]) + (rnodes[1:] - rnodes[:-1])).tolist()
+
+    # the workers map the files themselves instead of receiving copies
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    @staticmethod
+    def write(dataset, path):
+        """
+        Stores a SICKDataset with ArrayTree-s in the columnar format.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        def save(name, values, dtype=numpy.int64):
+            numpy.save(os.path.join(path, name + '.npy'), numpy.asarray(values, dtype=dtype))
+
+        def offsets(lengths):
+            return numpy.concatenate([[0], numpy.cumsum(lengths, dtype=numpy.int64)])
+
+        for side, sentences, trees in (('l', dataset.lsentences, dataset.ltrees),
+                                       ('r', dataset.rsentences, dataset.rtrees)):
+            if any(not isinstance(tree, ArrayTree) for tree in trees):
+                raise ValueError('Only ArrayTree-s can be stored, rebuild the dataset')
+            save(side + 'tokens', [t for sentence in sentences for t in sentence.tolist()])
+            save(side + 'token_offsets', offsets([len(sentence) for sentence in sentences]))
+            save(side + 'node_offsets', offsets([tree.size() for tree in trees]))
+            for name in ColumnarSICKDataset.tree_columns:
+                save(side + name, [v for tree in trees for v in getattr(tree, name).tolist()])
+        save('labels', dataset.labels.tolist(), numpy.float32)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'num_classes': dataset.num_classes, 'size': len(dataset)}, f)
+        return ColumnarSICKDataset(path)
+
+
+def load_dataset(split_dir, cache_dir, vocab, num_classes):
+    """
+    :return: ColumnarSICKDataset from cache_dir, which is written on the first call.
+    """
+    if not os.path.isfile(os.path.join(cache_dir, 'meta.json')):
+        ColumnarSICKDataset.write(SICKDataset(split_dir, vocab, num_classes), cache_dir)
+    return ColumnarSICKDataset(cache_dir)
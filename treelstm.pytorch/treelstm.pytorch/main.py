@@ -16,18 +16,18 @@ from config import parse_args
 # IMPORT CONSTANTS
 import Constants
 # DATASET CLASS FOR SICK DATASET
-from dataset import SICKDataset
+from dataset import load_dataset
 # METRICS CLASS FOR EVALUATION
 from metrics import Metrics
 # NEURAL NETWORK MODULES/LAYERS
 from model import SimilarityTreeLSTM
 # TRAIN AND TEST HELPER FUNCTIONS
-from trainer import Trainer
+from trainer import Trainer, TrainerMP, make_optimizer, subsample
 # DATA HANDLING CLASSES
 from tree import Tree
 from vocab import Vocab
 # UTILITY FUNCTIONS
-from utils import load_word_vectors, build_vocab
+from utils import load_word_vectors, build_vocab, copy_word_vectors
 
 
 def prepare_to_train(data=None, glove=None):
@@ -40,9 +40,6 @@ def prepare_to_train(data=None, glove=None):
     args.input_dim, args.mem_dim = 300, 150
     args.hidden_dim, args.num_classes = 50, 5
     args.cuda = args.cuda and torch.cuda.is_available()
-    if args.sparse and args.wd != 0:
-        print('Sparsity and weight decay are incompatible, pick one!')
-        exit()
     print(args)
     torch.manual_seed(args.seed)
     random.seed(args.seed)
@@ -72,26 +69,14 @@ def prepare_to_train(data=None, glove=None):
     print('==> SICK vocabulary size : %d ' % vocab.size())
 
     # load SICK dataset splits
-    train_file = os.path.join(args.data, 'sick_train.pth')
-    if os.path.isfile(train_file):
-        train_dataset = torch.load(train_file)
-    else:
-        train_dataset = SICKDataset(train_dir, vocab, args.num_classes)
-        torch.save(train_dataset, train_file)
+    train_dataset = load_dataset(train_dir, os.path.join(args.data, 'sick_train'), vocab,
+                                 args.num_classes)
     print('==> Size of train data   : %d ' % len(train_dataset))
-    dev_file = os.path.join(args.data, 'sick_dev.pth')
-    if os.path.isfile(dev_file):
-        dev_dataset = torch.load(dev_file)
-    else:
-        dev_dataset = SICKDataset(dev_dir, vocab, args.num_classes)
-        torch.save(dev_dataset, dev_file)
+    dev_dataset = load_dataset(dev_dir, os.path.join(args.data, 'sick_dev'), vocab,
+                               args.num_classes)
     print('==> Size of dev data     : %d ' % len(dev_dataset))
-    test_file = os.path.join(args.data, 'sick_test.pth')
-    if os.path.isfile(test_file):
-        test_dataset = torch.load(test_file)
-    else:
-        test_dataset = SICKDataset(test_dir, vocab, args.num_classes)
-        torch.save(test_dataset, test_file)
+    test_dataset = load_dataset(test_dir, os.path.join(args.data, 'sick_test'), vocab,
+                                args.num_classes)
     print('==> Size of test data    : %d ' % len(test_dataset))
 
     # initialize model, criterion/loss_function, optimizer
@@ -99,16 +84,11 @@ def prepare_to_train(data=None, glove=None):
         args.cuda, vocab.size(),
         args.input_dim, args.mem_dim,
         args.hidden_dim, args.num_classes,
-        args.sparse)
+        args.sparse, args.fused)
     criterion = nn.KLDivLoss()
     if args.cuda:
         model.cuda(), criterion.cuda()
-    if args.optim == 'adam':
-        optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
-    elif args.optim == 'adagrad':
-        optimizer = optim.Adagrad(model.parameters(), lr=args.lr, weight_decay=args.wd)
-    elif args.optim == 'sgd':
-        optimizer = optim.SGD(model.parameters(), lr=args.lr, weight_decay=args.wd)
+    optimizer = make_optimizer(args, model)
     metrics = Metrics(args.num_classes)
 
     # for words common to dataset vocab and GLOVE, use GLOVE vectors
@@ -118,16 +98,15 @@ def prepare_to_train(data=None, glove=None):
         emb = torch.load(emb_file)
     else:
         # load glove embeddings and vocab
-        glove_vocab, glove_emb = load_word_vectors(os.path.join(args.glove, 'glove.840B.300d'))
+        glove_vocab, glove_emb = load_word_vectors(os.path.join(args.glove, 'glove.840B.300d'),
+                                                   vocab)
         print('==> GLOVE vocabulary size: %d ' % glove_vocab.size())
         emb = torch.Tensor(vocab.size(), glove_emb.size(1)).normal_(-0.05, 0.05)
         # zero out the embeddings for padding and other special words if they are absent in vocab
         for idx, item in enumerate([Constants.PAD_WORD, Constants.UNK_WORD, Constants.BOS_WORD,
                                     Constants.EOS_WORD]):
             emb[idx].zero_()
-        for word in vocab.labelToIdx.keys():
-            if glove_vocab.get_index(word):
-                emb[vocab.get_index(word)] = glove_emb[glove_vocab.get_index(word)]
+        copy_word_vectors(emb, vocab, glove_vocab, glove_emb)
         torch.save(emb, emb_file)
     # plug these into embedding matrix inside model
     if args.cuda:
@@ -149,9 +128,6 @@ def main():
     args.input_dim, args.mem_dim = 300, 150
     args.hidden_dim, args.num_classes = 50, 5
     args.cuda = args.cuda and torch.cuda.is_available()
-    if args.sparse and args.wd != 0:
-        print('Sparsity and weight decay are incompatible, pick one!')
-        exit()
     print(args)
     torch.manual_seed(args.seed)
     random.seed(args.seed)
@@ -181,26 +157,14 @@ def main():
     print('==> SICK vocabulary size : %d ' % vocab.size())
 
     # load SICK dataset splits
-    train_file = os.path.join(args.data, 'sick_train.pth')
-    if os.path.isfile(train_file):
-        train_dataset = torch.load(train_file)
-    else:
-        train_dataset = SICKDataset(train_dir, vocab, args.num_classes)
-        torch.save(train_dataset, train_file)
+    train_dataset = load_dataset(train_dir, os.path.join(args.data, 'sick_train'), vocab,
+                                 args.num_classes)
     print('==> Size of train data   : %d ' % len(train_dataset))
-    dev_file = os.path.join(args.data, 'sick_dev.pth')
-    if os.path.isfile(dev_file):
-        dev_dataset = torch.load(dev_file)
-    else:
-        dev_dataset = SICKDataset(dev_dir, vocab, args.num_classes)
-        torch.save(dev_dataset, dev_file)
+    dev_dataset = load_dataset(dev_dir, os.path.join(args.data, 'sick_dev'), vocab,
+                               args.num_classes)
     print('==> Size of dev data     : %d ' % len(dev_dataset))
-    test_file = os.path.join(args.data, 'sick_test.pth')
-    if os.path.isfile(test_file):
-        test_dataset = torch.load(test_file)
-    else:
-        test_dataset = SICKDataset(test_dir, vocab, args.num_classes)
-        torch.save(test_dataset, test_file)
+    test_dataset = load_dataset(test_dir, os.path.join(args.data, 'sick_test'), vocab,
+                                args.num_classes)
     print('==> Size of test data    : %d ' % len(test_dataset))
 
     # initialize model, criterion/loss_function, optimizer
@@ -208,16 +172,11 @@ def main():
                 args.cuda, vocab.size(),
                 args.input_dim, args.mem_dim,
                 args.hidden_dim, args.num_classes,
-                args.sparse)
+                args.sparse, args.fused)
     criterion = nn.KLDivLoss()
     if args.cuda:
         model.cuda(), criterion.cuda()
-    if args.optim == 'adam':
-        optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
-    elif args.optim == 'adagrad':
-        optimizer = optim.Adagrad(model.parameters(), lr=args.lr, weight_decay=args.wd)
-    elif args.optim == 'sgd':
-        optimizer = optim.SGD(model.parameters(), lr=args.lr, weight_decay=args.wd)
+    optimizer = make_optimizer(args, model)
     metrics = Metrics(args.num_classes)
 
     # for words common to dataset vocab and GLOVE, use GLOVE vectors
@@ -227,16 +186,15 @@ def main():
         emb = torch.load(emb_file)
     else:
         # load glove embeddings and vocab
-        glove_vocab, glove_emb = load_word_vectors(os.path.join(args.glove, 'glove.840B.300d'))
+        glove_vocab, glove_emb = load_word_vectors(os.path.join(args.glove, 'glove.840B.300d'),
+                                                   vocab)
         print('==> GLOVE vocabulary size: %d ' % glove_vocab.size())
         emb = torch.Tensor(vocab.size(),glove_emb.size(1)).normal_(-0.05, 0.05)
         # zero out the embeddings for padding and other special words if they are absent in vocab
         for idx, item in enumerate([Constants.PAD_WORD, Constants.UNK_WORD, Constants.BOS_WORD,
                                     Constants.EOS_WORD]):
             emb[idx].zero_()
-        for word in vocab.labelToIdx.keys():
-            if glove_vocab.get_index(word):
-                emb[vocab.get_index(word)] = glove_emb[glove_vocab.get_index(word)]
+        copy_word_vectors(emb, vocab, glove_vocab, glove_emb)
         torch.save(emb, emb_file)
     # plug these into embedding matrix inside model
     if args.cuda:
@@ -244,17 +202,25 @@ def main():
     model.childsumtreelstm.emb.state_dict()['weight'].copy_(emb)
 
     # create trainer object for training and testing
-    trainer = Trainer(args, model, criterion, optimizer)
+    if args.processes > 1:
+        trainer = TrainerMP(args, model, criterion, optimizer, num_processes=args.processes)
+    else:
+        trainer = Trainer(args, model, criterion, optimizer)
 
     best = -float('inf')
+    train_indices = subsample(len(train_dataset), args.train_eval_samples, args.seed)
+    train_labels = train_dataset.labels if train_indices is None else \
+        train_dataset.labels.index_select(0, train_indices)
     for epoch in range(args.epochs):
         _ = trainer.train(train_dataset)
-        train_loss, train_pred = trainer.test(train_dataset)
+        if (epoch + 1) % args.eval_every != 0 and epoch + 1 < args.epochs:
+            continue
+        train_loss, train_pred = trainer.test(train_dataset, train_indices)
         dev_loss, dev_pred = trainer.test(dev_dataset)
         test_loss, test_pred = trainer.test(test_dataset)
 
-        train_pearson = metrics.pearson(train_pred,train_dataset.labels)
-        train_mse = metrics.mse(train_pred,train_dataset.labels)
+        train_pearson = metrics.pearson(train_pred, train_labels)
+        train_mse = metrics.mse(train_pred, train_labels)
         print('==> Train    Loss: {}\tPearson: {}\tMSE: {}'.format(train_loss, train_pearson,
                                                                    train_mse))
         dev_pearson = metrics.pearson(dev_pred, dev_dataset.labels)
@@ -267,11 +233,16 @@ def main():
 
         if best < test_pearson:
             best = test_pearson
-            checkpoint = {'model': trainer.model.state_dict(), 'optim': trainer.optimizer,
+            # the workers of TrainerMP step their own optimizers
+            optim_state = trainer.optimizer_state() if args.processes > 1 else \
+                trainer.optimizer.state_dict()
+            checkpoint = {'model': trainer.model.state_dict(), 'optim': optim_state,
                           'pearson': test_pearson, 'mse': test_mse,
                           'args': args, 'epoch': epoch }
             print('==> New optimum found, checkpointing everything now...')
             torch.save(checkpoint, '%s.pt' % os.path.join(args.save, args.expname+'.pth'))
+    if args.processes > 1:
+        trainer.close()
 
 if __name__ == "__main__":
     main()
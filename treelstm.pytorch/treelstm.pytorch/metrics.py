@@ -1,7 +1,4 @@
-from copy import deepcopy
 import torch
-import torch.nn as nn
-from torch.autograd import Variable as Var
 
 
 class Metrics:
@@ -10,16 +7,12 @@ class Metrics:
 
     @staticmethod
     def pearson(predictions, labels):
-        x = deepcopy(predictions)
-        y = deepcopy(labels)
-        x -= x.mean()
+        x = predictions - predictions.mean()
         x /= x.std()
-        y -= y.mean()
+        y = labels - labels.mean()
         y /= y.std()
         return torch.mean(torch.mul(x,y))
 
     @staticmethod
     def mse(predictions, labels):
-        x = Var(deepcopy(predictions), volatile=True)
-        y = Var(deepcopy(labels), volatile=True)
-        return nn.MSELoss()(x,y).data[0]
+        return torch.mean((predictions - labels) ** 2)
@@ -4,6 +4,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import Constants
+from tree import ArrayTree
 
 
 class ChildSumTreeLSTM(nn.Module):
@@ -54,12 +55,91 @@ class ChildSumTreeLSTM(nn.Module):
     def forward(self, tree, inputs):
         # add singleton dimension for future call to node_forward
         embs = F.torch.unsqueeze(self.emb(inputs), 1)
+        if isinstance(tree, ArrayTree):
+            return self.array_forward(tree, embs)
         for idx in range(tree.num_children):
             _ = self.forward(tree.children[idx], inputs)
         child_c, child_h = self.get_child_states(tree)
         tree.state = self.node_forward(embs[tree.idx], child_c, child_h)
         return tree.state
 
+    def array_forward(self, tree, embs):
+        """
+        Iterative post-order evaluation of an ArrayTree, the states are not stored
+        in the tree.
+        """
+        states = [None] * tree.size()
+        idx = tree.idx.tolist()
+        offsets = tree.child_offsets.tolist()
+        children = tree.children.tolist()
+        for node in tree.postorder.tolist():
+            kids = children[offsets[node]:offsets[node + 1]]
+            if kids:
+                child_c = F.torch.cat([states[k][0].view(1, 1, -1) for k in kids], 0)
+                child_h = F.torch.cat([states[k][1].view(1, 1, -1) for k in kids], 0)
+            else:
+                child_c = Var(embs.data.new(1, 1, self.mem_dim).zero_())
+                child_h = Var(embs.data.new(1, 1, self.mem_dim).zero_())
+            states[node] = self.node_forward(embs[idx[node]], child_c, child_h)
+        return states[0]
+
+    def forward_batch(self, batch):
+        """
+        Computes all the nodes of the same height in a batch of trees at once.
+
+        :param batch: batch.TreeBatch
+        :return: (c, h) of the roots, each of shape (number of trees, mem_dim)
+        """
+        embs = self.emb(Var(batch.tokens, volatile=batch.volatile))
+        # the input projections of all the nodes are computed upfront
+        iou_x, fx = self.project_inputs(embs)
+        pending = [[] for _ in range(batch.num_levels)]
+        roots_c, roots_h = [], []
+        for level in range(batch.num_levels):
+            start = batch.offsets[level]
+            size = batch.offsets[level + 1] - start
+            child_h_sum = Var(fx.data.new(size, self.mem_dim).zero_())
+            fc_sum = Var(fx.data.new(size, self.mem_dim).zero_())
+            if pending[level]:
+                positions = Var(torch.cat([p for p, _, _ in pending[level]], 0))
+                child_h_sum = child_h_sum.index_add(
+                    0, positions, torch.cat([h for _, h, _ in pending[level]], 0))
+                fc_sum = fc_sum.index_add(
+                    0, positions, torch.cat([fc for _, _, fc in pending[level]], 0))
+                pending[level] = None
+
+            i, o, u = self.iou_gates([p.narrow(0, start, size) for p in iou_x], child_h_sum)
+            c = F.torch.mul(i, u) + fc_sum
+            h = F.torch.mul(o, F.tanh(c))
+
+            for plevel, child_pos, parent_pos, parent_ids in batch.children[level]:
+                child_pos = Var(child_pos)
+                child_h = h.index_select(0, child_pos)
+                child_c = c.index_select(0, child_pos)
+                f = F.sigmoid(self.fh(child_h) + fx.index_select(0, Var(parent_ids)))
+                pending[plevel].append((parent_pos, child_h, F.torch.mul(f, child_c)))
+            if batch.roots[level] is not None:
+                root_pos = Var(batch.roots[level])
+                roots_c.append(c.index_select(0, root_pos))
+                roots_h.append(h.index_select(0, root_pos))
+        root_order = Var(batch.root_order)
+        c = torch.cat(roots_c, 0).index_select(0, root_order)
+        h = torch.cat(roots_h, 0).index_select(0, root_order)
+        return c, h
+
+    def project_inputs(self, embs):
+        """
+        :return: (list of the input projections for iou_gates(), forget gate input projection)
+        """
+        return [self.ix(embs), self.ox(embs), self.ux(embs)], self.fx(embs)
+
+    def iou_gates(self, iou_x, child_h_sum):
+        ix, ox, ux = iou_x
+        i = F.sigmoid(ix + self.ih(child_h_sum))
+        o = F.sigmoid(ox + self.oh(child_h_sum))
+        u = F.tanh(ux + self.uh(child_h_sum))
+        return i, o, u
+
     def get_child_states(self, tree):
         # add extra singleton dimension in middle...
         # because pytorch needs mini batches... :sad:
@@ -78,6 +158,78 @@ class ChildSumTreeLSTM(nn.Module):
         return child_c, child_h
 
 
+class FusedChildSumTreeLSTM(ChildSumTreeLSTM):
+    """
+    ChildSumTreeLSTM with the input, output and update gates computed by a single input
+    and a single hidden projection, and the forget gates of all the children by one matmul
+    """
+    def __init__(self, cuda, vocab_size, in_dim, mem_dim, sparsity):
+        nn.Module.__init__(self)
+        self.cuda_flag = cuda
+        self.in_dim = in_dim
+        self.mem_dim = mem_dim
+
+        self.emb = nn.Embedding(vocab_size, in_dim, padding_idx=Constants.PAD, sparse=sparsity)
+
+        # rows are the i, o, u gates
+        self.ioux = nn.Linear(self.in_dim, 3 * self.mem_dim)
+        self.iouh = nn.Linear(self.mem_dim, 3 * self.mem_dim)
+
+        self.fx = nn.Linear(self.in_dim, self.mem_dim)
+        self.fh = nn.Linear(self.mem_dim, self.mem_dim)
+
+    def node_forward(self, inputs, child_c, child_h):
+        inputs = inputs.view(1, self.in_dim)
+        child_c = child_c.view(-1, self.mem_dim)
+        child_h = child_h.view(-1, self.mem_dim)
+        child_h_sum = F.torch.sum(child_h, 0, keepdim=True)
+
+        i, o, u = self.iou_gates([self.ioux(inputs)], child_h_sum)
+        f = F.sigmoid(self.fh(child_h) + self.fx(inputs).expand_as(child_h))
+
+        c = F.torch.mul(i, u) + F.torch.sum(F.torch.mul(f, child_c), 0, keepdim=True)
+        h = F.torch.mul(o, F.tanh(c))
+
+        return c, h
+
+    def project_inputs(self, embs):
+        return [self.ioux(embs)], self.fx(embs)
+
+    def iou_gates(self, iou_x, child_h_sum):
+        iou = iou_x[0] + self.iouh(child_h_sum)
+        i, o, u = F.torch.chunk(iou, 3, 1)
+        return F.sigmoid(i), F.sigmoid(o), F.tanh(u)
+
+
+_IOU_PARAMS = [(src, param) for src in ('x', 'h') for param in ('weight', 'bias')]
+
+
+def fuse_state_dict(state_dict, prefix=''):
+    """
+    Converts the ChildSumTreeLSTM parameters to FusedChildSumTreeLSTM ones by concatenating
+    the ix/ox/ux and ih/oh/uh weights.
+    """
+    state_dict = state_dict.copy()
+    for src, param in _IOU_PARAMS:
+        keys = ['%s%s%s.%s' % (prefix, gate, src, param) for gate in 'iou']
+        state_dict['%siou%s.%s' % (prefix, src, param)] = torch.cat(
+            [state_dict.pop(key) for key in keys], 0)
+    return state_dict
+
+
+def unfuse_state_dict(state_dict, prefix=''):
+    """
+    Converts the FusedChildSumTreeLSTM parameters to ChildSumTreeLSTM ones by splitting
+    the iou weights.
+    """
+    state_dict = state_dict.copy()
+    for src, param in _IOU_PARAMS:
+        fused = state_dict.pop('%siou%s.%s' % (prefix, src, param))
+        for gate, value in zip('iou', torch.chunk(fused, 3, 0)):
+            state_dict['%s%s%s.%s' % (prefix, gate, src, param)] = value.contiguous()
+    return state_dict
+
+
 class Similarity(nn.Module):
     """
     Distance-angle similarity
@@ -105,14 +257,46 @@ class SimilarityTreeLSTM(nn.Module):
     """
     Putting the whole model together
     """
-    def __init__(self, cuda, vocab_size, in_dim, mem_dim, hidden_dim, num_classes, sparsity):
+    def __init__(self, cuda, vocab_size, in_dim, mem_dim, hidden_dim, num_classes, sparsity,
+                 fused=False):
         super(SimilarityTreeLSTM, self).__init__()
         self.cuda_flag = cuda
-        self.childsumtreelstm = ChildSumTreeLSTM(cuda, vocab_size, in_dim, mem_dim, sparsity)
+        self.fused = fused
+        treelstm = FusedChildSumTreeLSTM if fused else ChildSumTreeLSTM
+        self.childsumtreelstm = treelstm(cuda, vocab_size, in_dim, mem_dim, sparsity)
         self.similarity = Similarity(cuda, mem_dim, hidden_dim, num_classes)
+        # changes whenever the parameters change, invalidates cache.EncodingCache: bumped by
+        # cache.VersionedOptimizer, load_state_dict() and after the Hogwild workers trained
+        self.version = 0
+
+    def bump_version(self):
+        self.version += 1
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        # checkpoints of the other variant are converted
+        prefix = 'childsumtreelstm.'
+        if self.fused and prefix + 'ix.weight' in state_dict:
+            state_dict = fuse_state_dict(state_dict, prefix)
+        elif not self.fused and prefix + 'ioux.weight' in state_dict:
+            state_dict = unfuse_state_dict(state_dict, prefix)
+        self.bump_version()
+        return super(SimilarityTreeLSTM, self).load_state_dict(state_dict, *args, **kwargs)
 
     def forward(self, ltree, linputs, rtree, rinputs):
         lstate, lhidden = self.childsumtreelstm(ltree, linputs)
         rstate, rhidden = self.childsumtreelstm(rtree, rinputs)
         output = self.similarity(lstate, rstate)
         return output
+
+    def forward_batch(self, lbatch, rbatch):
+        """
+        Level batched equivalent of forward() for many pairs at once.
+
+        :param lbatch: batch.TreeBatch with the left trees.
+        :param rbatch: batch.TreeBatch with the right trees.
+        :return: log probabilities of shape (number of pairs, num_classes)
+        """
+        lstate, lhidden = self.childsumtreelstm.forward_batch(lbatch)
+        rstate, rhidden = self.childsumtreelstm.forward_batch(rbatch)
+        output = self.similarity(lstate, rstate)
+        return output
@@ -0,0 +1,136 @@
+import json
+import os
+import resource
+import time
+
+import torch
+
+
+class _NoopPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        return False
+
+
+_NOOP_PHASE = _NoopPhase()
+
+
+class _Phase(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *args):
+        if self.profiler.cuda:
+            # the kernels run asynchronously
+            torch.cuda.synchronize()
+        times = self.profiler.times
+        times[self.name] = times.get(self.name, 0.0) + time.time() - self.start
+        return False
+
+
+# per phase timings of the training and evaluation loops
+class Profiler(object):
+    """
+    Accumulates the time spent in each phase (fetch, copy, forward, backward, step, evaluate),
+    the number of processed tree nodes and samples, and appends them together with the peak
+    memory to a JSON lines file on every dump(). When disabled, phase() returns a shared no-op
+    context manager. The first profile_steps optimizer steps can be captured with
+    torch.autograd.profiler, the trace is written next to the log - by the first dump() if the
+    pass had fewer steps.
+    """
+    def __init__(self, output=None, profile_steps=0, cuda=False, worker=None):
+        """
+        :param output: path of the JSON lines log, None disables the profiler.
+        :param worker: rank of the Hogwild worker which writes the records.
+        """
+        self.enabled = output is not None
+        self.output = output
+        self.profile_steps = profile_steps
+        self.cuda = cuda
+        self.worker = worker
+        self.steps = 0
+        self._autograd = None
+        self.reset()
+
+    @staticmethod
+    def from_args(args, worker=None):
+        return Profiler(args.profile, args.profile_steps, args.cuda, worker)
+
+    def reset(self):
+        self.times = {}
+        self.nodes = 0
+        self.samples = 0
+        self.start = time.time()
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NOOP_PHASE
+        if name == 'fetch' and self._autograd is None and self.profile_steps:
+            # the capture starts with the first training sample
+            self._autograd = torch.autograd.profiler.profile(**({'use_cuda': True} if self.cuda
+                                                                 else {}))
+            self._autograd.__enter__()
+        return _Phase(self, name)
+
+    def count(self, nodes, samples=1):
+        if not self.enabled:
+            return
+        self.nodes += nodes
+        self.samples += samples
+
+    def step(self):
+        """
+        Called after every optimizer step, drives the autograd profiler.
+        """
+        if self._autograd is None or self.steps >= self.profile_steps:
+            return
+        self.steps += 1
+        if self.steps == self.profile_steps:
+            self._write_trace()
+
+    def _write_trace(self):
+        self._autograd.__exit__(None, None, None)
+        # no new capture starts after the trace was written
+        self.steps = self.profile_steps
+        suffix = '' if self.worker is None else '.%d' % self.worker
+        self._autograd.export_chrome_trace(
+            os.path.splitext(self.output)[0] + suffix + '.trace.json')
+        print(self._autograd.key_averages().table(sort_by='cpu_time_total'))
+
+    def dump(self, kind, epoch):
+        if not self.enabled:
+            return
+        if self._autograd is not None and self.steps < self.profile_steps:
+            # the pass had fewer steps than profile_steps, the partial capture is written
+            self._write_trace()
+        elapsed = time.time() - self.start
+        record = {
+            'time': time.time(),
+            'kind': kind,
+            'epoch': epoch,
+            'seconds': elapsed,
+            'phases': self.times,
+            'samples': self.samples,
+            'nodes': self.nodes,
+            'nodes_per_second': self.nodes / elapsed if elapsed > 0 else 0,
+            # kilobytes on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        }
+        if self.worker is not None:
+            record['worker'] = self.worker
+        if self.cuda:
+            record['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / float(1 << 20)
+        # single line appends from several processes do not interleave
+        with open(self.output, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+        self.reset()
+
+
+NOOP_PROFILER = Profiler()
@@ -0,0 +1,110 @@
+import json
+
+import numpy
+import torch
+from torch.autograd import Variable as Var
+
+from batch import TreeBatch
+from utils import no_grad
+
+
+# nearest neighbour search over the precomputed ChildSumTreeLSTM states of a corpus
+class TreeIndex(object):
+    """
+    The root memory cells of the corpus trees are stored row by row in a float32 matrix
+    which is memory mapped from <path>.states, <path>.json keeps its shape. A query tree
+    is encoded once and the Similarity head scores it against all the rows at once, or
+    only against the rows closest by cosine when prefilter is set.
+    """
+    def __init__(self, path):
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        self.path = path
+        self.states = numpy.memmap(path + '.states', dtype=numpy.float32, mode='r',
+                                   shape=(meta['size'], meta['mem_dim']))
+        self.norms = None
+
+    def __len__(self):
+        return self.states.shape[0]
+
+    @staticmethod
+    def build(model, trees, sentences, path, batch_size=256):
+        """
+        Encodes the corpus and writes the index files.
+
+        :param model: SimilarityTreeLSTM
+        :param trees: list of tree.ArrayTree-s or tree.Tree roots.
+        :param sentences: list of LongTensor-s with the token ids.
+        :return: TreeIndex
+        """
+        model.eval()
+        mem_dim = model.childsumtreelstm.mem_dim
+        states = numpy.memmap(path + '.states', dtype=numpy.float32, mode='w+',
+                              shape=(max(len(trees), 1), mem_dim))
+        with no_grad():
+            for start in range(0, len(trees), batch_size):
+                batch = TreeBatch.from_trees(trees[start:start + batch_size],
+                                             sentences[start:start + batch_size])
+                batch.volatile = True
+                if model.cuda_flag:
+                    batch.cuda()
+                c, _ = model.childsumtreelstm.forward_batch(batch)
+                states[start:start + len(batch)] = c.data.cpu().numpy()
+        states.flush()
+        del states
+        with open(path + '.json', 'w') as f:
+            json.dump({'size': len(trees), 'mem_dim': mem_dim}, f)
+        return TreeIndex(path)
+
+    def candidates(self, state, number, chunk_size=65536):
+        """
+        :return: indices of the rows with the highest cosine similarity to the state.
+        """
+        if len(self) == 0:
+            return numpy.arange(0)
+        if self.norms is None:
+            self.norms = numpy.concatenate([
+                numpy.linalg.norm(self.states[i:i + chunk_size], axis=1)
+                for i in range(0, len(self), chunk_size)])
+            self.norms[self.norms == 0] = 1
+        state = state / max(numpy.linalg.norm(state), 1e-12)
+        scores = numpy.concatenate([self.states[i:i + chunk_size].dot(state)
+                                    for i in range(0, len(self), chunk_size)]) / self.norms
+        if number >= len(scores):
+            return numpy.arange(len(scores))
+        return numpy.argpartition(-scores, number)[:number]
+
+    def query(self, model, tree, sentence, k=10, prefilter=0, chunk_size=65536):
+        """
+        :param prefilter: rerank only this many rows closest by cosine, 0 scores all.
+        :return: list of (row, predicted similarity) in the descending order.
+        """
+        model.eval()
+        batch = TreeBatch.from_trees([tree], [sentence])
+        batch.volatile = True
+        if model.cuda_flag:
+            batch.cuda()
+        with no_grad():
+            lstate, _ = model.childsumtreelstm.forward_batch(batch)
+        if prefilter:
+            # sorted rows read the memory map sequentially
+            rows = numpy.sort(self.candidates(lstate.data[0].cpu().numpy(), prefilter,
+                                              chunk_size))
+        else:
+            rows = numpy.arange(len(self))
+        classes = torch.arange(1, model.similarity.num_classes + 1).float()
+        scores = []
+        with no_grad():
+            for start in range(0, len(rows), chunk_size):
+                rstate = torch.from_numpy(numpy.ascontiguousarray(
+                    self.states[rows[start:start + chunk_size]]))
+                if model.cuda_flag:
+                    rstate = rstate.cuda()
+                rstate = Var(rstate, volatile=True)
+                output = model.similarity(lstate.expand_as(rstate), rstate)
+                scores.append(torch.mv(torch.exp(output.data.cpu()), classes))
+        if not scores:
+            return []
+        scores = torch.cat(scores, 0)
+        best, order = torch.topk(scores, min(k, len(scores)))
+        return [(int(rows[i]), float(score)) for i, score in zip(order.tolist(), best.tolist())]
@@ -1,10 +1,20 @@
 """
 Preprocessing script for SICK data.
 
+The parser invocations run concurrently in a bounded process pool. Every step records
+the content hashes of its input and outputs in sick/.preprocess.json and is skipped
+while they still match, so re-running after a small change only redoes what changed.
 """
 
-import os
+import argparse
 import glob
+import hashlib
+import json
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+MANIFEST = '.preprocess.json'
 
 
 def make_dirs(dirs):
@@ -13,6 +23,40 @@ def make_dirs(dirs):
             os.makedirs(d)
 
 
+def file_hash(filepath):
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def run_java(args, inputpath, outputs):
+    """
+    Runs the parser writing to temporary files which replace the outputs only on success,
+    so an interrupted run never leaves outputs which look up to date. The dependency and
+    constituency parses of the same file both write the identical .toks.
+
+    :param outputs: dict from the parser flag to the output path.
+    """
+    tmp = {flag: '%s.%d.tmp' % (path, os.getpid()) for flag, path in outputs.items()}
+    cmd = list(args)
+    for flag, path in sorted(tmp.items()):
+        cmd += [flag, path]
+    try:
+        with open(inputpath) as stdin:
+            code = subprocess.call(cmd, stdin=stdin)
+        if code != 0:
+            raise RuntimeError('%s failed with exit code %d' % (' '.join(cmd), code))
+        for flag, path in outputs.items():
+            os.rename(tmp[flag], path)
+    finally:
+        for path in tmp.values():
+            if os.path.exists(path):
+                os.remove(path)
+    return sorted(outputs.values())
+
+
 def dependency_parse(filepath, cp='', tokenize=True):
     print('\nDependency parsing ' + filepath)
     dirpath = os.path.dirname(filepath)
@@ -20,34 +64,39 @@ def dependency_parse(filepath, cp='', tokenize=True):
     tokpath = os.path.join(dirpath, filepre + '.toks')
     parentpath = os.path.join(dirpath, filepre + '.parents')
     relpath = os.path.join(dirpath, filepre + '.rels')
-    tokenize_flag = '-tokenize - ' if tokenize else ''
-    cmd = ('java -cp %s DependencyParse -tokpath %s -parentpath %s -relpath %s %s < %s'
-           % (cp, tokpath, parentpath, relpath, tokenize_flag, filepath))
-    os.system(cmd)
+    tokenize_flag = ['-tokenize', '-'] if tokenize else []
+    return run_java(['java', '-cp', cp, 'DependencyParse'] + tokenize_flag, filepath,
+                    {'-tokpath': tokpath, '-parentpath': parentpath, '-relpath': relpath})
 
 
 def constituency_parse(filepath, cp='', tokenize=True):
+    print('\nConstituency parsing ' + filepath)
     dirpath = os.path.dirname(filepath)
     filepre = os.path.splitext(os.path.basename(filepath))[0]
     tokpath = os.path.join(dirpath, filepre + '.toks')
     parentpath = os.path.join(dirpath, filepre + '.cparents')
-    tokenize_flag = '-tokenize - ' if tokenize else ''
-    cmd = ('java -cp %s ConstituencyParse -tokpath %s -parentpath %s %s < %s'
-           % (cp, tokpath, parentpath, tokenize_flag, filepath))
-    os.system(cmd)
+    tokenize_flag = ['-tokenize', '-'] if tokenize else []
+    return run_java(['java', '-cp', cp, 'ConstituencyParse'] + tokenize_flag, filepath,
+                    {'-tokpath': tokpath, '-parentpath': parentpath})
+
 
+def build_vocab(filepaths, dst_paths):
+    """
+    Builds several vocabularies in a single pass over the token files.
 
-def build_vocab(filepaths, dst_path, lowercase=True):
-    vocab = set()
+    :param dst_paths: dict from the output path to whether the words are lowercased.
+    """
+    vocabs = {dst_path: set() for dst_path in dst_paths}
     for filepath in filepaths:
         with open(filepath) as f:
             for line in f:
-                if lowercase:
-                    line = line.lower()
-                vocab |= set(line.split())
-    with open(dst_path, 'w') as f:
-        for w in sorted(vocab):
-            f.write(w + '\n')
+                words, lower_words = line.split(), line.lower().split()
+                for dst_path, lowercase in dst_paths.items():
+                    vocabs[dst_path].update(lower_words if lowercase else words)
+    for dst_path, vocab in vocabs.items():
+        with open(dst_path, 'w') as f:
+            for w in sorted(vocab):
+                f.write(w + '\n')
 
 
 def split(filepath, dst_dir):
@@ -63,15 +112,72 @@ def split(filepath, dst_dir):
                 afile.write(a + '\n')
                 bfile.write(b + '\n')
                 simfile.write(sim + '\n')
+    return [os.path.join(dst_dir, name) for name in ('a.txt', 'b.txt', 'id.txt', 'sim.txt')]
+
+
+class Manifest(object):
+    """
+    Content hashes of the inputs and outputs of every step, keyed by the step name.
+    """
+    def __init__(self, path, force=False):
+        self.path = path
+        self.steps = {}
+        if not force and os.path.isfile(path):
+            with open(path) as f:
+                self.steps = json.load(f)
+
+    def up_to_date(self, name, inputs):
+        step = self.steps.get(name)
+        if step is None or step['inputs'] != {p: file_hash(p) for p in inputs}:
+            return False
+        return all(os.path.isfile(p) and file_hash(p) == h for p, h in step['outputs'].items())
+
+    def record(self, name, inputs, outputs):
+        self.steps[name] = {'inputs': {p: file_hash(p) for p in inputs},
+                            'outputs': {p: file_hash(p) for p in outputs}}
+        # written after every step so that an interrupted run keeps its progress
+        with open(self.path, 'w') as f:
+            json.dump(self.steps, f, indent=1, sort_keys=True)
+
+
+def parse_jobs(dirpath, cp=''):
+    """
+    :return: list of (step name, function, input path, kwargs).
+    """
+    jobs = []
+    for name in ('a.txt', 'b.txt'):
+        filepath = os.path.join(dirpath, name)
+        for parse in (dependency_parse, constituency_parse):
+            jobs.append(('%s:%s' % (parse.__name__, filepath), parse, filepath,
+                         {'cp': cp, 'tokenize': True}))
+    return jobs
+
+
+def parse(dirpaths, manifest, cp='', processes=None):
+    """
+    Runs the parse jobs which are not up to date, at most processes at once.
+    """
+    jobs = [job for dirpath in dirpaths for job in parse_jobs(dirpath, cp)]
+    pending = [(name, func, filepath, kwargs) for name, func, filepath, kwargs in jobs
+               if not manifest.up_to_date(name, [filepath])]
+    print('%d of %d parse jobs are up to date' % (len(jobs) - len(pending), len(jobs)))
+    if not pending:
+        return
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(func, filepath, **kwargs): (name, filepath)
+                   for name, func, filepath, kwargs in pending}
+        for future in as_completed(futures):
+            name, filepath = futures[future]
+            manifest.record(name, [filepath], future.result())
 
 
-def parse(dirpath, cp=''):
-    dependency_parse(os.path.join(dirpath, 'a.txt'), cp=cp, tokenize=True)
-    dependency_parse(os.path.join(dirpath, 'b.txt'), cp=cp, tokenize=True)
-    constituency_parse(os.path.join(dirpath, 'a.txt'), cp=cp, tokenize=True)
-    constituency_parse(os.path.join(dirpath, 'b.txt'), cp=cp, tokenize=True)
-
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocessing SICK dataset')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of parallel parser processes (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true', help='redo all the steps')
+    args = parser.parse_args()
+
     print('=' * 80)
     print('Preprocessing SICK dataset')
     print('=' * 80)
@@ -84,6 +190,7 @@ if __name__ == '__main__':
     dev_dir = os.path.join(sick_dir, 'dev')
     test_dir = os.path.join(sick_dir, 'test')
     make_dirs([train_dir, dev_dir, test_dir])
+    manifest = Manifest(os.path.join(sick_dir, MANIFEST), force=args.force)
 
     # java classpath for calling Stanford parser
     classpath = ':'.join([lib_dir, os.path.join(lib_dir, 'stanford-parser/stanford-parser.jar'),
@@ -91,17 +198,20 @@ if __name__ == '__main__':
                                        'stanford-parser/stanford-parser-3.5.1-models.jar')])
 
     # split into separate files
-    split(os.path.join(sick_dir, 'SICK_train.txt'), train_dir)
-    split(os.path.join(sick_dir, 'SICK_trial.txt'), dev_dir)
-    split(os.path.join(sick_dir, 'SICK_test_annotated.txt'), test_dir)
+    for filename, dst_dir in (('SICK_train.txt', train_dir), ('SICK_trial.txt', dev_dir),
+                              ('SICK_test_annotated.txt', test_dir)):
+        filepath = os.path.join(sick_dir, filename)
+        name = 'split:' + filepath
+        if not manifest.up_to_date(name, [filepath]):
+            manifest.record(name, [filepath], split(filepath, dst_dir))
 
     # parse sentences
-    parse(train_dir, cp=classpath)
-    parse(dev_dir, cp=classpath)
-    parse(test_dir, cp=classpath)
+    parse([train_dir, dev_dir, test_dir], manifest, cp=classpath, processes=args.processes)
 
     # get vocabulary
-    build_vocab(glob.glob(os.path.join(sick_dir, '*/*.toks')), os.path.join(sick_dir, 'vocab.txt'))
-    build_vocab(glob.glob(os.path.join(sick_dir, '*/*.toks')), os.path.join(sick_dir,
-                                                                            'vocab-cased.txt'),
-                lowercase=False)
+    token_files = sorted(glob.glob(os.path.join(sick_dir, '*/*.toks')))
+    vocab_files = {os.path.join(sick_dir, 'vocab.txt'): True,
+                   os.path.join(sick_dir, 'vocab-cased.txt'): False}
+    if not manifest.up_to_date('vocab', token_files):
+        build_vocab(token_files, vocab_files)
+        manifest.record('vocab', token_files, sorted(vocab_files))
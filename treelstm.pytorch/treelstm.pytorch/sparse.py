@@ -0,0 +1,102 @@
+import math
+
+import torch.nn as nn
+
+
+def sparse_parameters(model):
+    """
+    :return: list of the parameters which receive sparse gradients.
+    """
+    return [module.weight for module in model.modules()
+            if isinstance(module, nn.Embedding) and module.sparse]
+
+
+# weight decay for sparse gradients, applied lazily to the rows being updated
+class SparseAwareOptimizer(object):
+    """
+    Steps a regular optimizer over the dense parameters and another one without weight decay
+    over the parameters with sparse gradients, so each step only touches the embedding rows
+    of the current batch. The decay those rows missed since their last update is caught up
+    by prepare() right before the batch looks them up: row *= (1 - lr * weight_decay) **
+    skipped_steps, so the gradients are computed at the decayed rows. This is exact for SGD
+    and the decoupled form of the weight decay for Adagrad and Adam. step() catches up the
+    rows which were not prepared as well, flush() brings all the rows up to date, e.g.
+    before evaluating or saving.
+    """
+    def __init__(self, dense, sparse, lr, weight_decay):
+        """
+        :param dense: optimizer of the dense parameters with the weight decay.
+        :param sparse: optimizer of the sparse parameters without the weight decay.
+        """
+        self.dense = dense
+        self.sparse = sparse
+        self.decay = 1 - lr * weight_decay
+        self.steps = 0
+        self.params = [p for group in sparse.param_groups for p in group['params']]
+        # the number of the steps whose decay each row has received
+        self.applied = [p.data.new(p.size(0)).zero_() for p in self.params]
+
+    @property
+    def param_groups(self):
+        return self.dense.param_groups + self.sparse.param_groups
+
+    def zero_grad(self):
+        self.dense.zero_grad()
+        self.sparse.zero_grad()
+
+    def _catch_up(self, param, applied, rows=None):
+        """
+        Applies the missed decay to the rows, all of them when rows is None.
+        """
+        lag = self.steps - (applied if rows is None else applied.index_select(0, rows))
+        if self.decay > 0:
+            factors = (lag * math.log(self.decay)).exp_()
+        else:
+            factors = (lag == 0).type_as(lag)
+        if rows is None:
+            param.data.mul_(factors.unsqueeze(1))
+            applied.fill_(self.steps)
+        else:
+            param.data.index_copy_(0, rows, param.data.index_select(0, rows) *
+                                   factors.unsqueeze(1))
+            applied.index_fill_(0, rows, self.steps)
+
+    def prepare(self, indices):
+        """
+        Applies the decay of the previous steps to the embedding rows the next forward pass
+        looks up.
+
+        :param indices: LongTensor of the token ids of the batch.
+        """
+        if self.decay != 1:
+            for param, applied in zip(self.params, self.applied):
+                self._catch_up(param, applied, indices.view(-1))
+
+    def step(self):
+        self.steps += 1
+        if self.decay != 1:
+            for param, applied in zip(self.params, self.applied):
+                if param.grad is None:
+                    continue
+                grad = param.grad.data
+                # the decay of the current step is applied along with the missed ones
+                self._catch_up(param, applied,
+                               grad.coalesce()._indices()[0] if grad.is_sparse else None)
+        self.dense.step()
+        self.sparse.step()
+
+    def flush(self):
+        if self.decay != 1:
+            for param, applied in zip(self.params, self.applied):
+                self._catch_up(param, applied)
+
+    def state_dict(self):
+        return {'dense': self.dense.state_dict(), 'sparse': self.sparse.state_dict(),
+                'steps': self.steps, 'applied': self.applied}
+
+    def load_state_dict(self, state_dict):
+        self.dense.load_state_dict(state_dict['dense'])
+        self.sparse.load_state_dict(state_dict['sparse'])
+        self.steps = state_dict['steps']
+        for applied, value in zip(self.applied, state_dict['applied']):
+            applied.copy_(value)
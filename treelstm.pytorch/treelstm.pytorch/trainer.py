@@ -1,5 +1,6 @@
-from copy import deepcopy
+import queue
 import time
+import traceback
 
 import torch
 from torch.autograd import Variable as Var
@@ -10,7 +11,11 @@ mp = _mp.get_context('spawn')
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from utils import map_label_to_target
+from batch import BucketSampler, PairCollator, Prefetcher, TreeBatch, pair_sizes
+from cache import EncodingCache, VersionedOptimizer
+from profiler import NOOP_PROFILER, Profiler
+from sparse import SparseAwareOptimizer, sparse_parameters
+from utils import map_label_to_target, no_grad
 
 
 def timeit(f):
@@ -21,12 +26,243 @@ def timeit(f):
         result = f(*args, **kw)
         te = time.time()
 
-        print("func:%r args:[%r, %r] took: %2.4f sec" % (f.__name__, args, kw, te-ts))
+        print("func:%r took: %2.4f sec" % (f.__name__, te-ts))
         return result
 
     return timed
 
 
+def make_batches(ltrees, lsents, rtrees, rsents, cuda, volatile=False):
+    lbatch = TreeBatch.from_trees(ltrees, lsents)
+    rbatch = TreeBatch.from_trees(rtrees, rsents)
+    lbatch.volatile = rbatch.volatile = volatile
+    if cuda:
+        lbatch.cuda(), rbatch.cuda()
+    return lbatch, rbatch
+
+
+def dataset_sizes(dataset):
+    # computed once and pickled along with the dataset to the workers
+    sizes = getattr(dataset, 'pair_sizes', None)
+    if sizes is None:
+        sizes = dataset.pair_sizes = pair_sizes(dataset)
+    return sizes
+
+
+def subsample(n_samples, size, seed):
+    """
+    :return: sorted fixed random subset of range(n_samples) of the given size, \
+             None if it is not smaller than n_samples.
+    """
+    if size <= 0 or size >= n_samples:
+        return None
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    return torch.randperm(n_samples, generator=generator)[:size].sort()[0]
+
+
+def make_optimizer(args, model):
+    """
+    With --sparse the sparse embeddings get an optimizer of their own, see
+    sparse.SparseAwareOptimizer. The steps bump the model version, see
+    cache.VersionedOptimizer.
+    """
+    sparse = sparse_parameters(model) if args.sparse else []
+    if not sparse:
+        optimizer = _make_optimizer(args.optim, model.parameters(), args.lr, args.wd)
+    else:
+        sparse_ids = set(id(p) for p in sparse)
+        dense = [p for p in model.parameters() if id(p) not in sparse_ids]
+        sparse_optim = 'sparse_adam' if args.optim == 'adam' else args.optim
+        optimizer = SparseAwareOptimizer(_make_optimizer(args.optim, dense, args.lr, args.wd),
+                                         _make_optimizer(sparse_optim, sparse, args.lr, 0),
+                                         args.lr, args.wd)
+    return VersionedOptimizer(optimizer, model)
+
+
+def _make_optimizer(name, parameters, lr, wd):
+    if name == 'adam':
+        return optim.Adam(parameters, lr=lr, weight_decay=wd)
+    elif name == 'sparse_adam':
+        # torch.optim.Adam does not accept sparse gradients
+        return optim.SparseAdam(parameters, lr=lr)
+    elif name == 'adagrad':
+        return optim.Adagrad(parameters, lr=lr, weight_decay=wd)
+    elif name == 'sgd':
+        return optim.SGD(parameters, lr=lr, weight_decay=wd)
+    raise ValueError('Unknown optimizer: %s' % name)
+
+
+def prepare_samples(dataset, indices, batched):
+    """
+    Fetches the samples and builds their targets and tree batches on the CPU.
+    """
+    for index in indices:
+        ltree, lsent, rtree, rsent, label = dataset[index]
+        target = map_label_to_target(label, dataset.num_classes)
+        batches = make_batches([ltree], [lsent], [rtree], [rsent], False) if batched else None
+        yield ltree, lsent, rtree, rsent, target, batches
+
+
+def prefetch(items, args):
+    """
+    :return: items prepared args.prefetch ahead in a background thread if enabled.
+    """
+    return Prefetcher(items, args.prefetch) if args.prefetch > 0 else items
+
+
+def train_samples(model, criterion, optimizer, args, dataset, indices, desc=None,
+                  profiler=NOOP_PROFILER):
+    """
+    Runs a training pass over dataset[indices], the optimizer steps every args.batchsize samples.
+
+    :return: sum of the losses
+    """
+    model.train()
+    optimizer.zero_grad()
+    sizes = dataset_sizes(dataset)
+    samples = prefetch(prepare_samples(dataset, indices, args.batched), args)
+    pending = iter(samples)
+    loss = 0.0
+    try:
+        for idx in tqdm(range(len(indices)), desc=desc, disable=desc is None):
+            with profiler.phase('fetch'):
+                ltree, lsent, rtree, rsent, target, batches = next(pending)
+            with profiler.phase('copy'):
+                linput, rinput = Var(lsent), Var(rsent)
+                target = Var(target)
+                if args.cuda:
+                    linput, rinput = linput.cuda(), rinput.cuda()
+                    target = target.cuda()
+                    if args.batched:
+                        batches[0].cuda(), batches[1].cuda()
+                if hasattr(optimizer, 'prepare'):
+                    optimizer.prepare(torch.cat([linput.data, rinput.data]))
+            with profiler.phase('forward'):
+                if args.batched:
+                    output = model.forward_batch(*batches)
+                else:
+                    output = model(ltree, linput, rtree, rinput)
+                err = criterion(output, target)
+            with profiler.phase('backward'):
+                loss += err.data[0]
+                err.backward()
+            profiler.count(sizes[int(indices[idx])])
+            if (idx + 1) % args.batchsize == 0:
+                with profiler.phase('step'):
+                    optimizer.step()
+                    optimizer.zero_grad()
+                profiler.step()
+    finally:
+        if isinstance(samples, Prefetcher):
+            samples.close()
+    return loss
+
+
+def train_minibatches(model, criterion, optimizer, args, dataset, indices, desc=None,
+                      profiler=NOOP_PROFILER):
+    """
+    Runs a training pass over dataset[indices] with one forward and backward pass per
+    mini-batch of args.batchsize pairs of similar size.
+
+    :return: sum of the losses
+    """
+    model.train()
+    loader = DataLoader(dataset, batch_sampler=BucketSampler(dataset_sizes(dataset),
+                                                             args.batchsize, indices),
+                        collate_fn=PairCollator(dataset.num_classes),
+                        num_workers=args.loader_workers)
+    # the worker processes prefetch themselves
+    loaded = prefetch(loader, args) if args.loader_workers == 0 else loader
+    batches = iter(loaded)
+    loss = 0.0
+    try:
+        for _ in tqdm(range(len(loader)), desc=desc, disable=desc is None):
+            with profiler.phase('fetch'):
+                lbatch, rbatch, target, _ = next(batches)
+            with profiler.phase('copy'):
+                target = Var(target)
+                if args.cuda:
+                    lbatch.cuda(), rbatch.cuda()
+                    target = target.cuda()
+                if hasattr(optimizer, 'prepare'):
+                    optimizer.prepare(torch.cat([lbatch.tokens, rbatch.tokens]))
+            optimizer.zero_grad()
+            with profiler.phase('forward'):
+                output = model.forward_batch(lbatch, rbatch)
+                # the criterion averages over the batch, the per sample loop sums the gradients
+                err = criterion(output, target) * len(lbatch)
+            with profiler.phase('backward'):
+                loss += err.data[0]
+                err.backward()
+            with profiler.phase('step'):
+                optimizer.step()
+            profiler.count(lbatch.num_nodes + rbatch.num_nodes, len(lbatch))
+            profiler.step()
+    finally:
+        if isinstance(loaded, Prefetcher):
+            loaded.close()
+    return loss
+
+
+def collate_samples(samples):
+    # the trees are batched by cache.EncodingCache
+    return tuple(zip(*samples))
+
+
+def evaluate(model, criterion, args, dataset, indices, desc=None, num_workers=0, cache=None,
+             profiler=NOOP_PROFILER):
+    """
+    Runs the model over dataset[indices] without the autograd history, args.eval_batchsize
+    pairs of similar size at a time. num_workers processes collate the batches.
+
+    :param cache: cache.EncodingCache which encodes every unique tree only once.
+    :return: sum of the losses, predicted similarity of each pair in the order of indices
+    """
+    model.eval()
+    sizes = dataset_sizes(dataset)
+    order = sorted(range(len(indices)), key=lambda pos: sizes[indices[pos]])
+    positions = [order[i:i + args.eval_batchsize]
+                 for i in range(0, len(order), args.eval_batchsize)]
+    loader = DataLoader(dataset, batch_sampler=[[indices[pos] for pos in batch]
+                                                for batch in positions],
+                        collate_fn=PairCollator(dataset.num_classes) if cache is None
+                        else collate_samples,
+                        num_workers=num_workers)
+    classes = torch.arange(1, dataset.num_classes + 1).float()
+    predictions = torch.zeros(len(indices))
+    loss = 0.0
+    with no_grad(), profiler.phase('evaluate'):
+        for batch, samples in tqdm(zip(positions, loader), desc=desc, total=len(positions),
+                                   disable=desc is None):
+            if cache is None:
+                lbatch, rbatch, target, _ = samples
+                lbatch.volatile = rbatch.volatile = True
+                if args.cuda:
+                    lbatch.cuda(), rbatch.cuda()
+                output = model.forward_batch(lbatch, rbatch)
+            else:
+                ltrees, lsents, rtrees, rsents, labels = samples
+                target = torch.cat([map_label_to_target(label, dataset.num_classes)
+                                    for label in labels], 0)
+                output = cache.forward(ltrees, lsents, rtrees, rsents)
+            target = Var(target, volatile=True)
+            if args.cuda:
+                target = target.cuda()
+            loss += criterion(output, target).data[0] * len(batch)
+            predictions.index_copy_(0, torch.LongTensor(batch),
+                                    torch.mv(torch.exp(output.data.cpu()), classes))
+            profiler.count(sum(sizes[int(indices[pos])] for pos in batch), len(batch))
+    return loss, predictions
+
+
+def train_epoch(model, criterion, optimizer, args, dataset, indices, desc=None,
+                profiler=NOOP_PROFILER):
+    train = train_minibatches if getattr(args, 'minibatch', False) else train_samples
+    return train(model, criterion, optimizer, args, dataset, indices, desc=desc,
+                 profiler=profiler)
+
+
 class Trainer(object):
     def __init__(self, args, model, criterion, optimizer):
         super(Trainer, self).__init__()
@@ -35,52 +271,51 @@ class Trainer(object):
         self.criterion = criterion
         self.optimizer = optimizer
         self.epoch = 0
+        self.cache = EncodingCache(model, args.eval_cache_size) if args.eval_cache else None
+        self.profiler = Profiler.from_args(args)
 
     # helper function for training
     @timeit
     def train(self, dataset):
-        self.model.train()
-        self.optimizer.zero_grad()
-        loss = 0.0
         indices = torch.randperm(len(dataset))
-        for idx in tqdm(range(len(dataset)), desc=('Training epoch ' + str(self.epoch + 1) + '')):
-            ltree, lsent, rtree, rsent, label = dataset[indices[idx]]
-            linput, rinput = Var(lsent), Var(rsent)
-            target = Var(map_label_to_target(label, dataset.num_classes))
-            if self.args.cuda:
-                linput, rinput = linput.cuda(), rinput.cuda()
-                target = target.cuda()
-            output = self.model(ltree, linput, rtree, rinput)
-            err = self.criterion(output, target)
-            loss += err.data[0]
-            err.backward()
-            if (idx + 1) % self.args.batchsize == 0:
-                self.optimizer.step()
-                self.optimizer.zero_grad()
+        self.profiler.reset()
+        loss = train_epoch(self.model, self.criterion, self.optimizer, self.args, dataset,
+                           indices, desc=('Training epoch ' + str(self.epoch + 1) + ''),
+                           profiler=self.profiler)
+        self.profiler.dump('train', self.epoch)
+        # the lazily decayed embedding rows are brought up to date for the evaluation
+        if hasattr(self.optimizer, 'flush'):
+            self.optimizer.flush()
         self.epoch += 1
         return loss / len(dataset)
 
     # helper function for testing
-    def test(self, dataset):
-        self.model.eval()
-        loss = 0
-        predictions = torch.zeros(len(dataset))
-        indices = torch.arange(1, dataset.num_classes + 1)
-        for idx in tqdm(range(len(dataset)), desc=('Testing epoch  ' + str(self.epoch) + '')):
-            ltree, lsent, rtree, rsent, label = dataset[idx]
-            linput, rinput = Var(lsent, volatile=True), Var(rsent, volatile=True)
-            target = Var(map_label_to_target(label, dataset.num_classes), volatile=True)
-            if self.args.cuda:
-                linput, rinput = linput.cuda(), rinput.cuda()
-                target = target.cuda()
-            output = self.model(ltree,linput,rtree,rinput)
-            err = self.criterion(output, target)
-            loss += err.data[0]
-            predictions[idx] = torch.dot(indices,torch.exp(output.data.cpu()))
-        return loss / len(dataset), predictions
+    def test(self, dataset, indices=None):
+        """
+        :param indices: evaluate only this subset of the dataset.
+        :return: mean loss, predictions in the order of indices
+        """
+        if indices is None:
+            indices = list(range(len(dataset)))
+        self.profiler.reset()
+        loss, predictions = evaluate(self.model, self.criterion, self.args, dataset, indices,
+                                     desc=('Testing epoch  ' + str(self.epoch) + ''),
+                                     num_workers=self.args.eval_workers, cache=self.cache,
+                                     profiler=self.profiler)
+        self.profiler.dump('test', self.epoch)
+        return loss / len(indices), predictions
 
 
 class TrainerMP(object):
+    """
+    Hogwild data parallel trainer: persistent worker processes update the parameters of the
+    shared model without locks, each with its own optimizer. Every epoch the samples are
+    deterministically shuffled and sharded between the workers, which report their losses back.
+    The same workers evaluate the shards of the test sets.
+    """
+    # seconds between the liveness checks of the workers while waiting for their results
+    POLL_SECONDS = 5
+
     def __init__(self, args, model, criterion, optimizer, num_processes=4):
         super(TrainerMP , self).__init__()
         self.args = args
@@ -89,119 +324,173 @@ class TrainerMP(object):
         self.optimizer = optimizer
         self.num_processes = num_processes
         self.epoch = 0
+        # (loss sum, number of samples) of each worker in the last epoch
+        self.worker_losses = []
+        self._workers = []
+        self._tasks = []
+        self._results = None
+        # the workers keep their copies of the datasets, which are sent only once
+        self._datasets = []
 
-    def prepare_dataloader(self, dataset, n_chunks=None):
-        # split dataset into n_chunks
-        if n_chunks is None:
-            n_chunks = self.num_processes
+    def start(self):
+        self.close()
+        self.model.share_memory()
+        self._results = mp.Queue()
+        self._tasks = [mp.Queue() for _ in range(self.num_processes)]
+        self._workers = [
+            mp.Process(target=_train_worker,
+                       args=(rank, self.model, self.criterion, self.args,
+                             self._tasks[rank], self._results))
+            for rank in range(self.num_processes)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
 
-        n_samples = len(dataset)
-        indices = torch.randperm(n_samples)
-        chunk_sz = n_samples // self.num_processes
+    def close(self):
+        for tasks in self._tasks:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers, self._tasks, self._datasets = [], [], []
 
-        chunks = []
+    def shard(self, n_samples, epoch):
+        generator = torch.Generator()
+        generator.manual_seed(self.args.seed + epoch)
+        indices = torch.randperm(n_samples, generator=generator)
+        return [indices[rank::self.num_processes] for rank in range(self.num_processes)]
 
-        for i in range(n_chunks):
-            if i == n_chunks - 1:
-                ds = DataLoader(self._slice_dataset(dataset, indices[i * chunk_sz:]),
-                                collate_fn=not_default_collate)
-                ds.num_classes = dataset.num_classes
-                chunks.append(ds)
-            else:
-                ds = DataLoader(self._slice_dataset(dataset,
-                                                    indices[i * chunk_sz:(i + 1) * chunk_sz]),
-                                collate_fn=not_default_collate)
-                ds.num_classes = dataset.num_classes
-                chunks.append(ds)
-        return chunks
-
-    @timeit
-    def train(self, dataset):
-        tr = self._train
+    def run(self, kind, dataset, shards):
+        """
+        Sends a shard of the dataset to every worker.
 
-        # split dataset into n_processes chunks
-        if isinstance(dataset[0], DataLoader):
-            chunks = dataset
+        :return: results of the workers by rank
+        """
+        if not self._workers:
+            self.start()
+        for key, known in enumerate(self._datasets):
+            if known is dataset:
+                break
         else:
-            chunks = self.prepare_dataloader(dataset)
-
-        # prepare parameters for parallel training
-        optimizer = self.optimizer
-        args = self.args
-        criterion = self.criterion
-        epoch = 0
-        model = self.model
-        # NOTE: this is required for the ``fork`` method to work
-        # model.share_memory()
-        processes = []
-        for i in range(self.num_processes):
-            p = mp.Process(target=tr, args=(model, optimizer, args, criterion, chunks[i], epoch))
-            p.start()
-            processes.append(p)
-        for p in processes:
-            p.join()
-        pass
+            key = len(self._datasets)
+            self._datasets.append(dataset)
+            dataset_sizes(dataset)
+            for tasks in self._tasks:
+                tasks.put(('data', key, dataset))
+        for rank, shard in enumerate(shards):
+            self._tasks[rank].put((kind, key, self.epoch, shard))
+        return self._collect()
 
-    # helper function for testing
-    def test(self, dataset):
-        self.model.eval()
-        loss = 0
-        predictions = torch.zeros(len(dataset))
-        indices = torch.arange(1, dataset.num_classes + 1)
-        for idx in tqdm(range(len(dataset)), desc=('Testing epoch  ' + str(self.epoch) + '')):
-            ltree, lsent, rtree, rsent, label = dataset[idx]
-            linput, rinput = Var(lsent, volatile=True), Var(rsent, volatile=True)
-            target = Var(map_label_to_target(label, dataset.num_classes), volatile=True)
-            if self.args.cuda:
-                linput, rinput = linput.cuda(), rinput.cuda()
-                target = target.cuda()
-            output = self.model(ltree, linput, rtree, rinput)
-            err = self.criterion(output, target)
-            loss += err.data[0]
-            predictions[idx] = torch.dot(indices, torch.exp(output.data.cpu()))
-        return loss / len(dataset), predictions
+    def _collect(self):
+        """
+        Waits for a result from every worker. A worker killed e.g. by the OOM killer never
+        answers, so the liveness of the workers is checked while waiting and the pool is
+        torn down when one of them is dead. The failures are raised after all the results
+        are received, otherwise they would be taken for the results of the next task.
 
-    # helper function for training
-    @staticmethod
-    def _train(model, optimizer, args, criterion, dataset, epoch):
-        model.train()
-        # construct optimizer
-        optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
-        optimizer.zero_grad()
-        loss = 0.0
-        indices = torch.randperm(len(dataset))
-        for idx, data in enumerate(dataset):
-            # ltree, lsent, rtree, rsent, label = dataset[indices[idx]]
-            ltree, lsent, rtree, rsent, label = data
-            linput, rinput = Var(lsent), Var(rsent)
-            target = Var(map_label_to_target(label, dataset.num_classes))
-            if args.cuda:
-                linput, rinput = linput.cuda(), rinput.cuda()
-                target = target.cuda()
-            output = model(ltree, linput, rtree, rinput)
-            err = criterion(output, target)
-            loss += err.data[0]
-            err.backward()
-            if (idx + 1) % args.batchsize == 0:
-                optimizer.step()
-                optimizer.zero_grad()
-        epoch += 1
-        return loss / len(dataset)
+        :return: results of the workers by rank
+        """
+        results = [None] * self.num_processes
+        failures = []
+        for _ in range(self.num_processes):
+            while True:
+                try:
+                    rank, result = self._results.get(timeout=self.POLL_SECONDS)
+                    break
+                except queue.Empty:
+                    dead = [(rank, worker.exitcode) for rank, worker in enumerate(self._workers)
+                            if not worker.is_alive()]
+                    if dead:
+                        self.terminate()
+                        raise RuntimeError('Workers died: %s' % ', '.join(
+                            '%d with exit code %s' % item for item in dead))
+            if isinstance(result, str):
+                failures.append('Worker %d failed:\n%s' % (rank, result))
+            else:
+                results[rank] = result
+        if failures:
+            raise RuntimeError('\n'.join(failures))
+        return results
 
-    @staticmethod
-    def _slice_dataset(dataset, indices):
-        d = deepcopy(dataset)
+    def terminate(self):
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        self._workers, self._tasks, self._datasets = [], [], []
 
-        d.lsentences = [dataset.lsentences[ind] for ind in indices]
-        d.rsentences = [dataset.rsentences[ind] for ind in indices]
-        d.ltrees = [dataset.ltrees[ind] for ind in indices]
-        d.rtrees = [dataset.rtrees[ind] for ind in indices]
-        d.labels = torch.Tensor([dataset.labels[ind] for ind in indices])
+    def optimizer_state(self):
+        """
+        The optimizer of the parent process is never stepped, each worker has its own.
 
-        d.size = d.labels.size(0)
+        :return: list of the optimizer state dicts of the workers by rank
+        """
+        if not self._workers:
+            return []
+        for tasks in self._tasks:
+            tasks.put(('state',))
+        return self._collect()
 
-        return d
+    @timeit
+    def train(self, dataset):
+        shards = self.shard(len(dataset), self.epoch)
+        self.worker_losses = [(loss, len(shard)) for loss, shard
+                              in zip(self.run('train', dataset, shards), shards)]
+        # the workers have changed the shared parameters
+        self.model.bump_version()
+        for rank, (loss, count) in enumerate(self.worker_losses):
+            print('==> Worker %d epoch %d loss: %f' % (rank, self.epoch + 1, loss / max(count, 1)))
+        self.epoch += 1
+        return sum(loss for loss, _ in self.worker_losses) / len(dataset)
+
+    # helper function for testing
+    def test(self, dataset, indices=None):
+        """
+        :param indices: evaluate only this subset of the dataset.
+        :return: mean loss, predictions in the order of indices
+        """
+        if indices is None:
+            indices = torch.arange(0, len(dataset)).long()
+        positions = torch.arange(0, len(indices)).long()
+        shards = [positions[rank::self.num_processes] for rank in range(self.num_processes)]
+        results = self.run('test', dataset, [indices.index_select(0, shard) for shard in shards])
+        predictions = torch.zeros(len(indices))
+        for shard, (_, shard_predictions) in zip(shards, results):
+            predictions.index_copy_(0, shard, shard_predictions)
+        return sum(loss for loss, _ in results) / len(indices), predictions
 
 
-def not_default_collate(batch):
-    return batch[0]
+def _train_worker(rank, model, criterion, args, tasks, results):
+    # one thread per worker, otherwise BLAS threads oversubscribe the cores
+    torch.set_num_threads(1)
+    torch.manual_seed(args.seed + rank)
+    # daemonic processes cannot start the DataLoader workers
+    args.loader_workers = 0
+    optimizer = make_optimizer(args, model)
+    cache = EncodingCache(model, args.eval_cache_size) if args.eval_cache else None
+    profiler = Profiler.from_args(args, worker=rank)
+    datasets = {}
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if task[0] == 'data':
+            datasets[task[1]] = task[2]
+            continue
+        if task[0] == 'state':
+            results.put((rank, optimizer.state_dict()))
+            continue
+        kind, key, epoch, indices = task
+        profiler.reset()
+        try:
+            if kind == 'train':
+                result = train_epoch(model, criterion, optimizer, args, datasets[key], indices,
+                                     profiler=profiler)
+                if hasattr(optimizer, 'flush'):
+                    optimizer.flush()
+            else:
+                result = evaluate(model, criterion, args, datasets[key], indices, cache=cache,
+                                  profiler=profiler)
+            profiler.dump(kind, epoch)
+            results.put((rank, result))
+        except Exception:
+            results.put((rank, traceback.format_exc()))
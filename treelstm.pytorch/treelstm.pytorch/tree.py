@@ -1,3 +1,6 @@
+import torch
+
+
 # tree object from stanfordnlp/treelstm
 class Tree(object):
     def __init__(self):
@@ -31,3 +34,106 @@ class Tree(object):
             count += 1
         self._depth = count
         return self._depth
+
+
+# immutable array backed tree, the model state is kept outside
+class ArrayTree(object):
+    """
+    The nodes are numbered in breadth first order, 0 is the root, so every parent
+    precedes its children. All the arrays are flat LongTensor-s:
+
+    idx - position of the node's token in the sentence
+    parents - parent of each node, -1 for the root
+    child_offsets, children - CSR children lists: the children of node i are
+        children[child_offsets[i]:child_offsets[i + 1]]
+    postorder - nodes in post-order
+    heights - height of each node, 0 for the leaves
+    """
+    __slots__ = ('idx', 'parents', 'child_offsets', 'children', 'postorder', 'heights')
+
+    def __init__(self, idx, parents, child_offsets, children, postorder, heights):
+        self.idx = idx
+        self.parents = parents
+        self.child_offsets = child_offsets
+        self.children = children
+        self.postorder = postorder
+        self.heights = heights
+
+    # plain lists pickle much smaller and faster than many tiny tensors
+    def __getstate__(self):
+        return tuple(getattr(self, name).tolist() for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, torch.LongTensor(value))
+
+    @classmethod
+    def from_parents(cls, parents):
+        """
+        :param parents: 1-based parent of each token as in the *.parents files: 0 marks \
+                        the root, -1 marks the tokens which are not in the tree.
+        """
+        num_tokens = len(parents)
+        # 1 - attached to the root, 0 - detached or being visited, None - unknown
+        attached = [None] * num_tokens
+        for i in range(num_tokens):
+            chain = []
+            j = i
+            while attached[j] is None:
+                attached[j] = 0
+                chain.append(j)
+                parent = parents[j]
+                if parent <= 0:
+                    attached[j] = int(parent == 0)
+                    break
+                j = parent - 1
+            value = attached[j]
+            for k in chain:
+                attached[k] = value
+        token_children = [[] for _ in range(num_tokens)]
+        root = None
+        for i in range(num_tokens):
+            if not attached[i]:
+                continue
+            if parents[i] == 0:
+                if root is None:
+                    root = i
+            else:
+                token_children[parents[i] - 1].append(i)
+
+        idx, node_parents, child_counts = [root], [-1], []
+        head = 0
+        while head < len(idx):
+            kids = token_children[idx[head]]
+            child_counts.append(len(kids))
+            idx.extend(kids)
+            node_parents.extend([head] * len(kids))
+            head += 1
+        size = len(idx)
+        child_offsets = [0] * (size + 1)
+        for i in range(size):
+            child_offsets[i + 1] = child_offsets[i] + child_counts[i]
+        # breadth first numbering: the children of node i are consecutive
+        children = list(range(1, size))
+        heights = [0] * size
+        for i in range(size - 1, 0, -1):
+            parent = node_parents[i]
+            heights[parent] = max(heights[parent], heights[i] + 1)
+        postorder = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            postorder.append(node)
+            stack.extend(children[child_offsets[node]:child_offsets[node + 1]])
+        postorder.reverse()
+        return cls(*(torch.LongTensor(a) for a in (
+            idx, node_parents, child_offsets, children, postorder, heights)))
+
+    def children_of(self, node):
+        return self.children[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+    def size(self):
+        return self.idx.size(0)
+
+    def depth(self):
+        return int(self.heights[0])
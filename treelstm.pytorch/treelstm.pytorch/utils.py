@@ -1,8 +1,11 @@
 from __future__ import print_function
 
+import hashlib
 import os
 import math
+from contextlib import contextmanager
 
+import numpy
 import torch
 
 from tree import Tree
@@ -12,7 +15,10 @@ from vocab import Vocab
 # loading GLOVE word vectors
 # if .pth file is found, will load that
 # else will load from .txt file & save
-def load_word_vectors(path):
+# with vocab, only its words are loaded and cached in <path>.<vocab digest>.npy
+def load_word_vectors(path, vocab=None):
+    if vocab is not None:
+        return load_filtered_word_vectors(path, vocab)
     if os.path.isfile(path+'.pth') and os.path.isfile(path+'.vocab'):
         print('==> File found, loading to memory')
         vectors = torch.load(path+'.pth')
@@ -21,19 +27,8 @@ def load_word_vectors(path):
     # saved file not found, read from txt file
     # and create tensors for word vectors
     print('==> File not found, preparing, be patient')
-    count = sum(1 for line in open(path+'.txt'))
-    with open(path+'.txt', 'r') as f:
-        contents = f.readline().rstrip('\n').split(' ')
-        dim = len(contents[1:])
-    words = [None] * count
-    vectors = torch.zeros(count, dim)
-    with open(path+'.txt', 'r') as f:
-        idx = 0
-        for line in f:
-            contents = line.rstrip('\n').split(' ')
-            words[idx] = contents[0]
-            vectors[idx] = torch.Tensor(list(map(float, contents[1:])))
-            idx += 1
+    words, vectors = read_word_vectors(path+'.txt')
+    vectors = torch.from_numpy(vectors)
     with open(path+'.vocab', 'w') as f:
         for word in words:
             f.write(word + '\n')
@@ -42,6 +37,78 @@ def load_word_vectors(path):
     return vocab, vectors
 
 
+def load_filtered_word_vectors(path, vocab):
+    labels = '\n'.join(sorted(vocab.labelToIdx.keys())).encode('utf-8')
+    cache = '%s.%s' % (path, hashlib.sha1(labels).hexdigest()[:16])
+    if not (os.path.isfile(cache+'.npy') and os.path.isfile(cache+'.vocab')):
+        print('==> Filtering %s.txt by the vocabulary' % path)
+        words, vectors = read_word_vectors(path+'.txt', set(labels.split(b'\n')))
+        numpy.save(cache+'.npy', vectors)
+        with open(cache+'.vocab', 'w') as f:
+            for word in words:
+                f.write(word + '\n')
+    # copy on write memory map: nothing is read until the rows are used
+    vectors = numpy.load(cache+'.npy', mmap_mode='c')
+    return Vocab(filename=cache+'.vocab'), torch.from_numpy(vectors)
+
+
+def read_word_vectors(filename, wanted=None, chunk_size=1 << 24):
+    """
+    Streams the text file in large chunks, the vectors of each chunk are parsed with a single
+    numpy call.
+
+    :param wanted: set of the utf-8 encoded words to keep, None keeps all the words. \
+                   Only the first occurrence of a word is kept.
+    :return: list of words, float32 numpy array of shape (number of words, dim)
+    """
+    words, blocks = [], []
+    seen = set()
+    dim = None
+    tail = b''
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop() if chunk else b''
+            values = []
+            for line in lines:
+                line = line.rstrip(b'\r')
+                if not line:
+                    continue
+                if dim is None:
+                    dim = len(line.split(b' ')) - 1
+                # a few words contain spaces themselves
+                if line.count(b' ') == dim:
+                    word = line[:line.index(b' ')]
+                else:
+                    word = line.rsplit(b' ', dim)[0]
+                if word in seen or (wanted is not None and word not in wanted):
+                    continue
+                seen.add(word)
+                words.append(word.decode('utf-8', 'replace'))
+                values.append(line[len(word) + 1:])
+            if values:
+                blocks.append(numpy.fromstring(b' '.join(values), dtype=numpy.float32, sep=' ')
+                              .reshape(len(values), dim))
+            if not chunk:
+                break
+    if not blocks:
+        return words, numpy.zeros((0, dim or 0), dtype=numpy.float32)
+    return words, numpy.concatenate(blocks)
+
+
+# copy the vectors of the words present in both vocabularies
+def copy_word_vectors(emb, vocab, vectors_vocab, vectors):
+    pairs = [(vocab.get_index(word), idx) for idx, word in vectors_vocab.idxToLabel.items()
+             if vocab.get_index(word) is not None]
+    if not pairs:
+        return emb
+    rows, sources = zip(*pairs)
+    emb.index_copy_(0, torch.LongTensor(rows),
+                    vectors.index_select(0, torch.LongTensor(sources)).type_as(emb))
+    return emb
+
+
 # write unique words from a set of files to a new file
 def build_vocab(filenames, vocabfile):
     vocab = set()
@@ -66,3 +133,13 @@ def map_label_to_target(label, num_classes):
         target[0][floor - 1] = ceil - label
         target[0][ceil - 1] = label - floor
     return target
+
+
+@contextmanager
+def no_grad():
+    # volatile Variables do the job before torch 0.4
+    if hasattr(torch, 'no_grad'):
+        with torch.no_grad():
+            yield
+    else:
+        yield